@@ -16,6 +16,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mcp_agent'))
 
 from mcp_agent.database_config import get_mysql_session, get_redis_client
+from mcp_agent.persistent_storage import decode_redis_message
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -91,8 +92,8 @@ async def cleanup_redis_messages():
     try:
         redis_client = await get_redis_client()
         
-        # 获取所有session键
-        session_keys = await redis_client.keys("session:*:messages")
+        # 获取所有session键（SCAN增量遍历，避免KEYS阻塞Redis）
+        session_keys = [key async for key in redis_client.scan_iter(match="session:*:messages", count=500)]
         deleted_count = 0
         
         for session_key in session_keys:
@@ -109,12 +110,12 @@ async def cleanup_redis_messages():
                         else:
                             msg_str = str(msg_data)
                         
-                        msg = json.loads(msg_str)
+                        msg = decode_redis_message(msg_str)
                         
                         # 检查是否是系统错误消息
                         is_system_error = False
                         if msg.get('sender_type') == 'agent':
-                            content = msg.get('message_content', '')
+                            content = msg.get('message_content') or ''
                             for pattern in SYSTEM_ERROR_PATTERNS:
                                 if pattern in content:
                                     logger.info(f"删除Redis消息: {content[:50]}...")
@@ -158,8 +159,8 @@ async def cleanup_inner_os_leak_messages():
     try:
         redis_client = await get_redis_client()
         
-        # 获取所有会话键
-        session_keys = await redis_client.keys("session:*:messages")
+        # 获取所有会话键（SCAN增量遍历，避免KEYS阻塞Redis）
+        session_keys = [key async for key in redis_client.scan_iter(match="session:*:messages", count=500)]
         
         cleaned_count = 0
         total_sessions = len(session_keys)
@@ -179,8 +180,8 @@ async def cleanup_inner_os_leak_messages():
                     else:
                         msg_str = str(msg_json)
                     
-                    msg = json.loads(msg_str)
-                    message_content = msg.get('message_content', '')
+                    msg = decode_redis_message(msg_str)
+                    message_content = msg.get('message_content') or ''
                     
                     # 检查是否包含内心OS泄露的模式
                     leak_patterns = [
@@ -7,9 +7,11 @@ MCP Agent - 增强版多工具集成聊天代理
 
 import asyncio
 import json
+import orjson
 import logging
+import re
 from pathlib import Path
-from typing import Dict, List, Any, Optional, TypedDict, Annotated
+from typing import Dict, List, Any, Optional, Tuple, TypedDict, Annotated
 from dataclasses import dataclass, asdict
 from datetime import datetime
 
@@ -24,14 +26,47 @@ from model_config import get_langchain_llm, get_model_config
 
 # 导入相关模块
 from client import MCPClient  
-from persistent_storage import PersistentConversationStorage
+from persistent_storage import PersistentConversationStorage, decode_redis_message
 from role_config import load_role_config, RoleConfig
 from role_detail import RoleMood
 from input_emotion_analyzer.analyzer import InputEmotionAnalyzer
 from thought_chain_prompt_generator.thought_chain_generator import ThoughtChainPromptGenerator
 
 # 导入角色详情管理器
-from role_detail import RoleDetailManager
+from role_detail import RoleDetailManager, invalidate_role_mood_cache
+
+# 查询错误分类：每个分组对应一类错误，分组序号越小优先级越高（一次扫描错误信息）
+# "googleapi" 必然包含 "api"，已归入第4类，这里不再单独匹配
+_QUERY_ERROR_RE = re.compile(
+    r"(user location is not supported|geographical)"
+    r"|(broken pipe|connection)"
+    r"|(timeout)"
+    r"|(api|quota|rate)"
+    r"|(gemini)",
+    re.IGNORECASE
+)
+
+# 错误分类 -> (系统消息, 角色回复)；空回复不会保存到历史记录，让角色状态保持正常
+_QUERY_ERROR_MESSAGES = {
+    1: ("⚠️ 地理位置限制：当前服务对您的地理位置有限制，请稍后再试。",
+        "不好意思，我这边有点技术问题，不过我们还是可以聊天的！你刚才问什么来着？"),
+    2: ("⚠️ 网络连接错误：网络连接出现问题，请检查网络设置或稍后再试。",
+        "网络好像有点问题，不过我还在这里！你可以重新问一下刚才的问题。"),
+    3: ("⚠️ 响应超时：服务响应超时，请稍后再试。",
+        "响应有点慢，可能是网络问题。你可以再试一次，或者换个问题问我。"),
+    4: ("⚠️ API服务错误：AI服务暂时不可用，可能是配额限制，请稍后再试。", ""),
+    5: ("⚠️ Google AI服务错误：Google AI服务出现问题，请稍后再试。", ""),
+}
+
+def _classify_query_error(error_message: str) -> Optional[int]:
+    """返回错误信息命中的最高优先级分类，未命中返回None"""
+    category = None
+    for match in _QUERY_ERROR_RE.finditer(error_message):
+        if category is None or match.lastindex < category:
+            category = match.lastindex
+            if category == 1:
+                break
+    return category
 
 # 简化的MCP客户端类 - 暂时替代MultiServerMCPClient
 class EnhancedMCPClient:
@@ -89,6 +124,8 @@ class EnhancedMCPAgent:
         self.l0_prompt_content = ""
         self.l1_prompt_content = self._load_l1_prompt()
         self.usetool_prompt_content = self._load_usetool_prompt()
+        self.inner_os_ban_prompt_content = self._load_inner_os_ban_prompt()
+        self.provocation_response_prompt_content = self._load_provocation_response_prompt()
         
         # 初始化情绪分析和内心OS生成器
         self.emotion_analyzer = InputEmotionAnalyzer()
@@ -245,6 +282,7 @@ class EnhancedMCPAgent:
             
             await redis_client.hset(redis_key, mapping=new_mood.to_dict())
             await redis_client.expire(redis_key, 86400)  # 24小时过期
+            invalidate_role_mood_cache(self.role_id)
             
             self.logger.info(f"✅ 角色情绪状态已更新: {self.role_id}")
             return True
@@ -310,36 +348,19 @@ class EnhancedMCPAgent:
             
             for msg_json in reversed(all_messages):  # 倒序遍历，最新的在前
                 try:
-                    # 处理消息可能已经是字符串或bytes的情况
-                    if isinstance(msg_json, bytes):
-                        msg_str = msg_json.decode('utf-8')
-                    elif isinstance(msg_json, str):
-                        msg_str = msg_json
-                    else:
-                        msg_str = str(msg_json)
-                    
-                    msg = json.loads(msg_str)
-                    msg_timestamp = msg.get('timestamp')
+                    # Redis客户端已启用decode_responses，消息直接是字符串
+                    msg = decode_redis_message(msg_json)
+                    # Redis消息的时间字段为created_at（ISO-8601字符串）
+                    msg_timestamp = msg.get('created_at')
                     
                     # 解析时间戳
-                    if msg_timestamp:
-                        # 支持多种时间戳格式
-                        if isinstance(msg_timestamp, (int, float)):
-                            msg_time = msg_timestamp
-                        elif isinstance(msg_timestamp, str):
-                            try:
-                                # 尝试解析ISO格式时间
-                                from datetime import datetime
-                                dt = datetime.fromisoformat(msg_timestamp.replace('Z', '+00:00'))
-                                msg_time = dt.timestamp()
-                            except:
-                                # 如果解析失败，尝试作为float处理
-                                try:
-                                    msg_time = float(msg_timestamp)
-                                except:
-                                    # 如果都失败了，跳过时间过滤
-                                    msg_time = current_time
-                        else:
+                    if isinstance(msg_timestamp, (int, float)):
+                        msg_time = msg_timestamp
+                    elif isinstance(msg_timestamp, str) and msg_timestamp:
+                        try:
+                            msg_time = datetime.fromisoformat(msg_timestamp.replace('Z', '+00:00')).timestamp()
+                        except ValueError:
+                            # 无法解析时不做时间过滤
                             msg_time = current_time
                     else:
                         msg_time = current_time
@@ -350,15 +371,14 @@ class EnhancedMCPAgent:
                         if msg.get('sender_type') in ['user', 'agent', 'human', 'ai', 'assistant']:
                             recent_messages.append({
                                 'type': msg.get('sender_type'),
-                                'content': msg.get('message_content', ''),
-                                'timestamp': msg.get('timestamp', ''),
-                                'user_name': msg.get('user_name', '')
+                                'content': msg.get('message_content') or '',
+                                'timestamp': msg_timestamp or ''
                             })
                     else:
                         # 由于是倒序遍历，如果遇到超出时间窗口的消息，后面的都更老，可以停止
                         break
                         
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     self.logger.warning(f"Failed to parse message JSON: {e}")
                     continue
                 except Exception as e:
@@ -437,8 +457,7 @@ class EnhancedMCPAgent:
             system_prompt += plot_info
         
         # 🚨 加载内心OS禁止指导
-        inner_os_ban_content = self._load_inner_os_ban_prompt()
-        system_prompt += f"{inner_os_ban_content}\n\n"
+        system_prompt += f"{self.inner_os_ban_prompt_content}\n\n"
         
         if inner_os:
             system_prompt += f"## 当前内心OS：\n{inner_os}\n\n"
@@ -460,8 +479,7 @@ class EnhancedMCPAgent:
         
         # 🚨 检测被挑衅情况并添加相应指导
         if self._detect_provocation_in_context():
-            provocation_guide = self._load_provocation_response_prompt()
-            system_prompt += f"## 🚨 被挑衅情况处理指导：\n{provocation_guide}\n\n"
+            system_prompt += f"## 🚨 被挑衅情况处理指导：\n{self.provocation_response_prompt_content}\n\n"
         
         system_prompt += f"{self.l1_prompt_content}\n\n"
         
@@ -868,8 +886,7 @@ class EnhancedMCPAgent:
                         
                     except Exception as tool_error:
                         # 如果工具调用失败，尝试使用简单的LLM响应
-                        error_str = str(tool_error).lower()
-                        if "user location is not supported" in error_str or "geographical" in error_str:
+                        if _classify_query_error(str(tool_error)) == 1:
                             self.logger.warning(f"[process_query session:{session_id}] Geographical restriction detected, falling back to simple LLM")
                             # 使用带内心OS的简化消息
                             llm_response = await self.llm.ainvoke(messages)
@@ -894,27 +911,14 @@ class EnhancedMCPAgent:
                     self.logger.info(f"[process_query session:{session_id}] Intelligent fallback response generated successfully")
 
             except Exception as e:
-                self.logger.error(f"[process_query session:{session_id}] Error during agent execution: {e}", exc_info=True)
-                
                 # 检查错误类型并设置系统消息，不污染角色回复
-                error_str = str(e).lower()
-                if "user location is not supported" in error_str or "geographical" in error_str:
-                    system_message = "⚠️ 地理位置限制：当前服务对您的地理位置有限制，请稍后再试。"
-                    response_content = "不好意思，我这边有点技术问题，不过我们还是可以聊天的！你刚才问什么来着？"
-                elif "broken pipe" in error_str or "connection" in error_str:
-                    system_message = "⚠️ 网络连接错误：网络连接出现问题，请检查网络设置或稍后再试。"
-                    response_content = "网络好像有点问题，不过我还在这里！你可以重新问一下刚才的问题。"
-                elif "timeout" in error_str:
-                    system_message = "⚠️ 响应超时：服务响应超时，请稍后再试。"
-                    response_content = "响应有点慢，可能是网络问题。你可以再试一次，或者换个问题问我。"
-                elif "api" in error_str or "quota" in error_str or "rate" in error_str:
-                    system_message = "⚠️ API服务错误：AI服务暂时不可用，可能是配额限制，请稍后再试。"
-                    # 不保存任何回复到历史记录，让角色状态保持正常
-                    response_content = ""
-                elif "googleapi" in error_str or "gemini" in error_str:
-                    system_message = "⚠️ Google AI服务错误：Google AI服务出现问题，请稍后再试。"
-                    response_content = ""
+                error_category = _classify_query_error(str(e))
+                if error_category is not None:
+                    # 已知错误（地理限制/网络/超时/配额等）无需记录堆栈
+                    self.logger.warning("[process_query session:%s] Known error during agent execution (category %s): %s", session_id, error_category, e)
+                    system_message, response_content = _QUERY_ERROR_MESSAGES[error_category]
                 else:
+                    self.logger.error(f"[process_query session:{session_id}] Error during agent execution: {e}", exc_info=True)
                     system_message = f"⚠️ 系统错误：{type(e).__name__} - 请稍后再试或联系技术支持。"
                     response_content = ""
                     
@@ -935,27 +939,6 @@ class EnhancedMCPAgent:
             else:
                 self.logger.info(f"[process_query session:{session_id}] No valid response to save, skipping message storage")
 
-            # 10. 改进的持久化策略：更积极地持久化数据
-            try:
-                # 获取当前Redis中的消息数量
-                from database_config import get_redis_client
-                redis_client = await get_redis_client()
-                session_key = f"session:{session_id}:messages"
-                message_count = await redis_client.llen(session_key)
-                
-                # 每3轮对话持久化一次，或者消息数量超过6条时持久化
-                should_persist = (message_count > 0 and message_count % 6 == 0) or message_count > 10
-                
-                if should_persist:
-                    self.logger.info(f"[process_query session:{session_id}] Triggering periodic persistence (message count: {message_count})")
-                    await self.conversation_storage.persist_redis_messages_to_mysql(session_id)
-                    self.logger.info(f"[process_query session:{session_id}] Periodic persistence completed")
-                else:
-                    self.logger.debug(f"[process_query session:{session_id}] Skipping persistence (message count: {message_count})")
-                    
-            except Exception as persist_error:
-                self.logger.error(f"[process_query session:{session_id}] Error during periodic persistence: {persist_error}", exc_info=True)
-
             self.logger.info(f"[process_query session:{session_id}] Returning response: '{response_content[:100] if response_content else 'SYSTEM_ERROR'}...', system_message: '{system_message}'")
             return {
                 **state,
@@ -1006,10 +989,9 @@ class EnhancedMCPAgent:
             })
             self.logger.info(f"[run session:{active_session_id}] Graph invocation successful")
             
-            # 在返回结果前，尝试强制持久化当前会话的数据
+            # 持久化当前会话的数据（后台定时刷写运行时会合并批量写入，不阻塞响应）
             try:
-                await self.conversation_storage.persist_redis_messages_to_mysql(active_session_id)
-                self.logger.info(f"[run session:{active_session_id}] Final persistence completed")
+                await self.conversation_storage.request_persist(active_session_id)
             except Exception as persist_error:
                 self.logger.warning(f"[run session:{active_session_id}] Final persistence failed: {persist_error}")
             
@@ -1065,13 +1047,31 @@ class EnhancedMCPAgent:
         """异步创建会话"""
         return await self.conversation_storage.create_session(user_id, title)
 
-    async def get_user_sessions_async(self, user_id: str) -> List[Dict[str, Any]]:
-        """异步获取用户会话"""
-        return await self.conversation_storage.get_user_sessions(user_id)
+    async def get_user_sessions_async(self, user_id: str, limit: int = 20, before: Optional[datetime] = None,
+                                      before_session_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """异步获取用户会话（before/before_session_id为上一页最后一个会话的组合游标）"""
+        return await self.conversation_storage.get_user_sessions(
+            user_id, limit=limit, before=before, before_session_id=before_session_id
+        )
+    
+    async def get_latest_session_for_role_async(self, user_id: str, role_id: str, role_name: str) -> Optional[Dict[str, Any]]:
+        """异步获取用户与指定角色最近的会话（会话标题包含角色名称或角色ID）"""
+        return await self.conversation_storage.get_latest_session_by_title(user_id, [role_name, role_id])
     
-    async def get_conversation_history_async(self, session_id: str) -> List[Dict[str, Any]]:
+    async def get_session_message_count_async(self, session_info: Dict[str, Any]) -> int:
+        """异步获取会话消息总数：MySQL会话统计中的计数加上Redis中尚未同步的计数"""
+        unpersisted = await self.conversation_storage.get_unpersisted_message_count(session_info['session_id'])
+        return (session_info.get('total_message_count') or 0) + unpersisted
+    
+    async def get_conversation_history_async(self, session_id: str, limit: int = 50,
+                                             before_order: Optional[int] = None) -> List[Dict[str, Any]]:
         """异步获取对话历史"""
-        return await self.conversation_storage.get_conversation_history(session_id)
+        return await self.conversation_storage.get_conversation_history(session_id, limit, before_order)
+
+    async def get_conversation_history_page_async(self, session_id: str, limit: int = 50,
+                                                  before_order: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """异步分页获取对话历史，返回 (消息列表, 下一页游标)"""
+        return await self.conversation_storage.get_conversation_history_page(session_id, limit, before_order)
 
     async def cleanup_session_async(self, session_id: str):
         """异步清理会话（持久化并清理Redis数据）"""
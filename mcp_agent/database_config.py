@@ -3,9 +3,13 @@
 包含MySQL和Redis的连接配置和管理
 """
 
+import asyncio
 import os
 import logging
-from typing import Optional
+import orjson
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncContextManager, AsyncIterator, Optional
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy import text
@@ -39,9 +43,14 @@ class DatabaseConfig:
         # 连接池配置
         self.mysql_pool_size = int(os.getenv('MYSQL_POOL_SIZE', '10'))
         self.mysql_max_overflow = int(os.getenv('MYSQL_MAX_OVERFLOW', '20'))
+        self.mysql_pool_timeout = int(os.getenv('MYSQL_POOL_TIMEOUT', '30'))
         
-        # Redis连接池配置
-        self.redis_max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', '10'))
+        # Redis连接池配置（连接数应不低于并发请求数，避免协程排队等待同一连接）
+        self.redis_max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+        self.redis_pool_timeout = int(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+        # Redis套接字超时（秒）：避免Redis无响应时请求和关闭流程无限挂起
+        self.redis_socket_timeout = float(os.getenv('REDIS_SOCKET_TIMEOUT', '2'))
+        self.redis_socket_connect_timeout = float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', '1'))
         
     @property
     def mysql_url(self) -> str:
@@ -64,6 +73,9 @@ mysql_engine = None
 async_session_maker = None
 redis_client = None
 
+# 当前上下文共享的MySQL会话（由mysql_session_scope()设置）
+_current_mysql_session: ContextVar[Optional[AsyncSession]] = ContextVar('current_mysql_session', default=None)
+
 async def init_mysql():
     """初始化MySQL连接"""
     global mysql_engine, async_session_maker
@@ -75,8 +87,10 @@ async def init_mysql():
             poolclass=AsyncAdaptedQueuePool,
             pool_size=db_config.mysql_pool_size,
             max_overflow=db_config.mysql_max_overflow,
+            pool_timeout=db_config.mysql_pool_timeout,  # 连接池耗尽时等待空闲连接的最长时间
             pool_pre_ping=True,
             pool_recycle=3600,  # 1小时回收连接
+            json_deserializer=orjson.loads,  # JSON列使用orjson解码
             echo=False  # 设置为True可以看到SQL日志
         )
         
@@ -103,13 +117,18 @@ async def init_redis():
     global redis_client
     
     try:
-        # 创建Redis连接池
-        redis_client = aioredis.from_url(
+        # 创建Redis连接池：连接耗尽时阻塞等待空闲连接（最多redis_pool_timeout秒），
+        # 而不是直接抛出连接数超限错误
+        pool = aioredis.BlockingConnectionPool.from_url(
             db_config.redis_url,
             max_connections=db_config.redis_max_connections,
+            timeout=db_config.redis_pool_timeout,
+            socket_timeout=db_config.redis_socket_timeout,
+            socket_connect_timeout=db_config.redis_socket_connect_timeout,
             retry_on_timeout=True,
             decode_responses=True  # 自动解码响应为字符串
         )
+        redis_client = aioredis.Redis(connection_pool=pool)
         
         # 测试连接
         await redis_client.ping()
@@ -133,14 +152,52 @@ async def close_redis():
     global redis_client
     if redis_client:
         await redis_client.close()
+        await redis_client.connection_pool.disconnect()
         logger.info("Redis连接已关闭")
 
-def get_mysql_session() -> AsyncSession:
-    """获取MySQL会话"""
+def get_mysql_session() -> AsyncContextManager[AsyncSession]:
+    """获取MySQL会话
+    
+    如果当前上下文已通过mysql_session_scope()打开了会话，则复用该会话，
+    退出async with时不会关闭它；否则从连接池创建新会话。
+    """
     if not async_session_maker:
         raise RuntimeError("MySQL未初始化，请先调用init_mysql()")
+    current_session = _current_mysql_session.get()
+    if current_session is not None:
+        return _reuse_mysql_session(current_session)
     return async_session_maker()
 
+@asynccontextmanager
+async def _reuse_mysql_session(session: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """复用共享会话；出错时回滚，避免会话停留在PendingRollback状态导致同一请求后续的调用全部失败"""
+    try:
+        yield session
+    except Exception:
+        await session.rollback()
+        raise
+
+@asynccontextmanager
+async def mysql_session_scope() -> AsyncIterator[AsyncSession]:
+    """在当前上下文中共享一个MySQL会话
+    
+    作用域内所有get_mysql_session()调用都复用同一个AsyncSession，
+    一次请求只签出一次连接。嵌套使用时直接复用外层会话。
+    """
+    current_session = _current_mysql_session.get()
+    if current_session is not None:
+        yield current_session
+        return
+    
+    if not async_session_maker:
+        raise RuntimeError("MySQL未初始化，请先调用init_mysql()")
+    async with async_session_maker() as session:
+        token = _current_mysql_session.set(session)
+        try:
+            yield session
+        finally:
+            _current_mysql_session.reset(token)
+
 async def get_redis_client():
     """获取Redis客户端"""
     if not redis_client:
@@ -148,11 +205,13 @@ async def get_redis_client():
     return redis_client
 
 # 数据库健康检查
+_HEALTH_CHECK_QUERY = text("SELECT 1")
+
 async def check_mysql_health() -> bool:
     """检查MySQL连接健康状态"""
     try:
         async with get_mysql_session() as session:
-            result = await session.execute(text("SELECT 1"))
+            result = await session.execute(_HEALTH_CHECK_QUERY)
             return result.scalar() == 1
     except Exception as e:
         logger.error(f"MySQL健康检查失败: {e}")
@@ -171,8 +230,8 @@ async def check_redis_health() -> bool:
 # 初始化所有数据库连接
 async def init_all_databases():
     """初始化所有数据库连接"""
-    mysql_ok = await init_mysql()
-    redis_ok = await init_redis()
+    # MySQL和Redis初始化互不依赖，并发执行缩短启动时间
+    mysql_ok, redis_ok = await asyncio.gather(init_mysql(), init_redis())
     
     if mysql_ok and redis_ok:
         logger.info("🎉 所有数据库连接初始化成功")
@@ -184,6 +243,5 @@ async def init_all_databases():
 # 关闭所有数据库连接
 async def close_all_databases():
     """关闭所有数据库连接"""
-    await close_mysql()
-    await close_redis()
+    await asyncio.gather(close_mysql(), close_redis())
     logger.info("所有数据库连接已关闭") 
\ No newline at end of file
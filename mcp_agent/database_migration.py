@@ -82,6 +82,31 @@ async def migrate_role_details_table():
         logger.error(f"❌ 迁移role_details表结构失败: {e}")
         raise
 
+async def migrate_chat_sessions_indexes():
+    """为chat_sessions表补充会话列表查询所需的索引（create_all不会给已存在的表加索引）"""
+    try:
+        async with get_mysql_session() as session:
+            result = await session.execute(text("""
+            SELECT DISTINCT INDEX_NAME 
+            FROM INFORMATION_SCHEMA.STATISTICS 
+            WHERE TABLE_NAME = 'chat_sessions' 
+            AND TABLE_SCHEMA = DATABASE()
+            """))
+            existing_indexes = {row[0] for row in result.fetchall()}
+            
+            if 'idx_user_status_last_message' not in existing_indexes:
+                logger.info("添加索引: idx_user_status_last_message")
+                await session.execute(text(
+                    "CREATE INDEX idx_user_status_last_message ON chat_sessions (user_name, status, last_message_at)"
+                ))
+                await session.commit()
+            
+            logger.info("✅ chat_sessions索引迁移完成")
+            
+    except Exception as e:
+        logger.error(f"❌ 迁移chat_sessions索引失败: {e}")
+        raise
+
 async def rollback_role_details_table():
     """回滚role_details表结构（仅供紧急情况使用）"""
     try:
@@ -151,6 +176,7 @@ async def main():
     else:
         # 迁移操作
         await migrate_role_details_table()
+        await migrate_chat_sessions_indexes()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
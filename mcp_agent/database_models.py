@@ -49,6 +49,8 @@ class ChatSession(Base):
     __table_args__ = (
         Index('idx_user_created', 'user_name', 'created_at'),
         Index('idx_user_last_message', 'user_name', 'last_message_at'),
+        # 支持按用户+状态过滤并按最后消息时间倒序分页，避免filesort
+        Index('idx_user_status_last_message', 'user_name', 'status', 'last_message_at'),
         Index('idx_status_created', 'status', 'created_at'),
     )
     
@@ -20,12 +20,17 @@ os.environ["AMAP_MAPS_API_KEY"] = AMAP_MAPS_API_KEY
 os.environ["BOCHA_API_KEY"] = BOCHA_API_KEY
 
 def get_config():
-    """获取配置信息"""
+    """获取配置信息（服务端配置在调用时从环境变量读取）"""
     model_config = get_model_config()
     return {
         "google_api_key": model_config.api_key,
         "amap_api_key": AMAP_MAPS_API_KEY,
         "bocha_api_key": BOCHA_API_KEY,
         "model_provider": model_config.provider.value,
-        "model_name": model_config.model_name
+        "model_name": model_config.model_name,
+        # 允许跨域的来源（CORS_ORIGINS，逗号分隔），未配置时允许任意来源
+        "cors_origins": [origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()],
+        # 查询超时与慢查询告警阈值（秒）
+        "query_timeout_sec": float(os.getenv("QUERY_TIMEOUT_SEC", "120")),
+        "slow_query_sec": float(os.getenv("SLOW_QUERY_SEC", "10"))
     } 
\ No newline at end of file
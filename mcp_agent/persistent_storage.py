@@ -3,12 +3,18 @@
 实现MySQL和Redis的会话和消息存储逻辑
 """
 
-import json
+import asyncio
+import heapq
 import logging
+import orjson
+import time
 import uuid
+import weakref
 from datetime import datetime
 from typing import Dict, Any, List, Optional, Tuple
-from sqlalchemy import select, update, desc, func, text
+from aioredis.exceptions import WatchError
+from cachetools import TTLCache
+from sqlalchemy import select, update, insert, desc, text, or_, and_
 from sqlalchemy.orm import selectinload
 
 from database_config import get_mysql_session, get_redis_client
@@ -16,6 +22,64 @@ from database_models import ChatSession, ChatMessage
 
 logger = logging.getLogger(__name__)
 
+# 预先构造的SQL语句，避免每次调用重复构造和解析
+_SELECT_MAX_MESSAGE_ORDER = text(
+    "SELECT COALESCE(MAX(message_order), 0) FROM chat_messages WHERE session_id = :session_id"
+)
+_INSERT_IGNORE_MESSAGES = insert(ChatMessage.__table__).prefix_with('IGNORE')
+_UPDATE_SESSION_STATS = text("""
+    UPDATE chat_sessions 
+    SET 
+        total_message_count = total_message_count + :total_delta,
+        user_message_count = user_message_count + :user_delta,
+        agent_message_count = agent_message_count + :agent_delta,
+        last_message_at = COALESCE(GREATEST(last_message_at, :last_message_time), :last_message_time, last_message_at)
+    WHERE session_id = :session_id
+""")
+_SELECT_SESSION_STATISTICS = text("""
+    SELECT 
+        s.session_id, s.user_name, s.session_title, s.created_at, s.last_message_at,
+        s.total_message_count, s.user_message_count, s.agent_message_count, s.status,
+        m.total_messages, m.user_messages, m.agent_messages, m.tool_queries
+    FROM chat_sessions s
+    CROSS JOIN (
+        SELECT 
+            COUNT(*) as total_messages,
+            SUM(sender_type = 'user') as user_messages,
+            SUM(sender_type = 'agent') as agent_messages,
+            SUM(is_tool_query) as tool_queries
+        FROM chat_messages 
+        WHERE session_id = :session_id
+    ) m
+    WHERE s.session_id = :session_id
+""")
+
+# 进程内会话信息缓存，热点会话无需每次访问Redis（asyncio单线程访问，无需加锁）。
+# 放在模块级而非实例上：持久化/清理工作协程各自创建的存储实例也能让代理实例的缓存失效
+_session_info_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
+
+# Redis中消息的紧凑存储格式：按固定位置存储字段的JSON数组，
+# 省去每条消息重复的键名以及可由会话上下文得到的session_id/user_name
+REDIS_MESSAGE_FIELDS = (
+    'message_id', 'sender_type', 'message_content', 'is_tool_query', 'tool_name',
+    'tool_parameters', 'tool_query_result', 'message_order', 'created_at',
+    'extra_metadata', 'persisted_to_mysql'
+)
+
+def encode_redis_message(message: Dict[str, Any]) -> bytes:
+    """将消息字典编码为Redis中的紧凑数组格式"""
+    return orjson.dumps([message.get(field) for field in REDIS_MESSAGE_FIELDS])
+
+def decode_redis_message(raw) -> Dict[str, Any]:
+    """解码Redis中的消息，兼容旧版的JSON对象格式（extra_metadata为JSON字符串）"""
+    data = orjson.loads(raw)
+    if isinstance(data, dict):
+        extra_metadata = data.get('extra_metadata')
+        if isinstance(extra_metadata, str):
+            data['extra_metadata'] = orjson.loads(extra_metadata) if extra_metadata else None
+        return data
+    return dict(zip(REDIS_MESSAGE_FIELDS, data))
+
 class PersistentConversationStorage:
     """持久化对话存储管理器"""
     
@@ -63,16 +127,14 @@ class PersistentConversationStorage:
                 'status': 'active'
             }
             
-            await redis_client.hset(
-                f"{self.redis_session_prefix}{session_id}",
-                mapping=session_data
-            )
-            
-            # 设置会话过期时间（24小时）
-            await redis_client.expire(f"{self.redis_session_prefix}{session_id}", 86400)
+            session_key = f"{self.redis_session_prefix}{session_id}"
             
-            # 初始化消息列表
-            await redis_client.delete(f"{self.redis_messages_prefix}{session_id}")
+            # 会话缓存写入、过期时间（24小时）和消息列表初始化合并为一次往返
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hset(session_key, mapping=session_data)
+                pipe.expire(session_key, 86400)
+                pipe.delete(f"{self.redis_messages_prefix}{session_id}")
+                await pipe.execute()
             
             self.logger.info(f"✅ 会话创建成功: {session_id} (用户: {user_name})")
             return session_id
@@ -81,15 +143,32 @@ class PersistentConversationStorage:
             self.logger.error(f"❌ 会话创建失败: {e}")
             raise
     
-    async def get_user_sessions(self, user_name: str, limit: int = 20) -> List[Dict[str, Any]]:
-        """获取用户的所有会话"""
+    async def get_user_sessions(self, user_name: str, limit: int = 20,
+                                before: Optional[datetime] = None,
+                                before_session_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """获取用户的所有会话
+        
+        before/before_session_id: 分页游标，传入上一页最后一个会话的last_message_at和session_id。
+        last_message_at只精确到秒，多个会话可能同一秒，按(last_message_at, session_id)组合键翻页，
+        同一秒的会话不会在页边界被跳过
+        """
         try:
             async with get_mysql_session() as db_session:
-                # 查询用户的会话，按最后消息时间排序
+                # 查询用户的会话，按最后消息时间排序（由idx_user_status_last_message索引提供顺序，
+                # InnoDB二级索引隐含主键session_id，组合排序同样走索引）
                 stmt = select(ChatSession).where(
                     ChatSession.user_name == user_name,
                     ChatSession.status == 'active'
-                ).order_by(desc(ChatSession.last_message_at)).limit(limit)
+                )
+                if before is not None:
+                    if before_session_id is not None:
+                        stmt = stmt.where(or_(
+                            ChatSession.last_message_at < before,
+                            and_(ChatSession.last_message_at == before, ChatSession.session_id < before_session_id)
+                        ))
+                    else:
+                        stmt = stmt.where(ChatSession.last_message_at < before)
+                stmt = stmt.order_by(desc(ChatSession.last_message_at), desc(ChatSession.session_id)).limit(limit)
                 
                 result = await db_session.execute(stmt)
                 sessions = result.scalars().all()
@@ -100,15 +179,42 @@ class PersistentConversationStorage:
             self.logger.error(f"❌ 获取用户会话失败: {e}")
             return []
     
+    async def get_latest_session_by_title(self, user_name: str, keywords: List[str]) -> Optional[Dict[str, Any]]:
+        """获取标题包含任一关键词的最近活跃会话
+        
+        沿idx_user_status_last_message索引按最后消息时间倒序查找，命中第一条即返回，
+        无需把用户的全部会话取回再在Python中过滤
+        """
+        try:
+            async with get_mysql_session() as db_session:
+                stmt = select(ChatSession).where(
+                    ChatSession.user_name == user_name,
+                    ChatSession.status == 'active',
+                    or_(*(ChatSession.session_title.contains(keyword, autoescape=True) for keyword in keywords))
+                ).order_by(desc(ChatSession.last_message_at)).limit(1)
+                
+                result = await db_session.execute(stmt)
+                session = result.scalar_one_or_none()
+                return session.to_dict() if session else None
+                
+        except Exception as e:
+            self.logger.error(f"❌ 获取最近会话失败: {e}")
+            return None
+    
     async def get_session_info(self, session_id: str) -> Optional[Dict[str, Any]]:
         """获取会话信息"""
+        cached = _session_info_cache.get(session_id)
+        if cached is not None:
+            return dict(cached)
+        
         try:
             # 先尝试从Redis获取
             redis_client = await get_redis_client()
             session_data = await redis_client.hgetall(f"{self.redis_session_prefix}{session_id}")
             
             if session_data:
-                return session_data
+                _session_info_cache[session_id] = session_data
+                return dict(session_data)
             
             # Redis中没有，从MySQL获取
             async with get_mysql_session() as db_session:
@@ -117,7 +223,9 @@ class PersistentConversationStorage:
                 session = result.scalar_one_or_none()
                 
                 if session:
-                    return session.to_dict()
+                    session_data = session.to_dict()
+                    _session_info_cache[session_id] = session_data
+                    return dict(session_data)
                     
             return None
             
@@ -139,31 +247,40 @@ class PersistentConversationStorage:
             # 生成消息ID
             message_id = str(uuid.uuid4())
             
-            # 获取当前会话的消息数量作为序号
+            # 通过原子自增计数器获取消息序号，避免并发写入时LLEN取到相同序号
             session_key = f"session:{session_id}:messages"
-            message_count = await redis_client.llen(session_key)
+            seq_key = f"session:{session_id}:msg_seq"
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.incr(seq_key)
+                pipe.expire(seq_key, 86400)
+                message_order, _ = await pipe.execute()
             
-            # 构建消息数据
+            # 构建消息数据（session_id/user_name由键名和会话信息确定，不再逐条存储）
             message_data = {
                 'message_id': message_id,
-                'session_id': session_id,
-                'user_name': user_name,
                 'sender_type': sender_type,
                 'message_content': message_content,
                 'is_tool_query': is_tool_query,
                 'tool_name': tool_name,
                 'tool_query_result': tool_query_result,
                 'tool_parameters': tool_parameters,
-                'message_order': message_count + 1,
+                'message_order': message_order,
                 'created_at': datetime.now().isoformat(),
-                'extra_metadata': json.dumps(extra_metadata or {})
+                'extra_metadata': extra_metadata or {}
             }
             
-            # 保存到Redis列表
-            await redis_client.lpush(session_key, json.dumps(message_data))
+            # 保存到Redis列表并设置过期时间（24小时），同时累加待同步到MySQL的会话计数
+            stats_key = f"session:{session_id}:stat_delta"
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.rpush(session_key, encode_redis_message(message_data))
+                pipe.expire(session_key, 86400)
+                pipe.hincrby(stats_key, 'total_message_count', 1)
+                if sender_type in ('user', 'agent'):
+                    pipe.hincrby(stats_key, f'{sender_type}_message_count', 1)
+                pipe.expire(stats_key, 86400)
+                await pipe.execute()
             
-            # 设置过期时间（24小时）
-            await redis_client.expire(session_key, 86400)
+            _mark_session_dirty(session_id)
             
             self.logger.info(f"[save_message_to_redis] Message saved to Redis: {message_id}")
             return message_id
@@ -172,19 +289,34 @@ class PersistentConversationStorage:
             self.logger.error(f"[save_message_to_redis] Error saving message to Redis: {e}")
             raise
     
-    async def get_conversation_history_from_mysql(self, session_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-        """从MySQL获取对话历史"""
+    async def get_unpersisted_message_count(self, session_id: str) -> int:
+        """Redis中尚未同步到MySQL会话统计的消息数"""
+        try:
+            redis_client = await get_redis_client()
+            value = await redis_client.hget(f"session:{session_id}:stat_delta", 'total_message_count')
+            return int(value) if value else 0
+        except Exception as e:
+            self.logger.error(f"❌ 获取未同步消息数失败: {e}")
+            return 0
+    
+    async def get_conversation_history_from_mysql(self, session_id: str, limit: int = 50,
+                                                  before_order: Optional[int] = None) -> List[Dict[str, Any]]:
+        """从MySQL获取对话历史
+        
+        before_order: 分页游标，只返回消息序号小于该值的消息（沿idx_session_order索引倒序读取）
+        """
         try:
             async with get_mysql_session() as db_session:
-                # 查询消息，按消息顺序排序
-                stmt = select(ChatMessage).where(
-                    ChatMessage.session_id == session_id
-                ).order_by(ChatMessage.message_order).limit(limit)
+                # 查询最近的limit条消息，再按消息顺序正序返回
+                stmt = select(ChatMessage).where(ChatMessage.session_id == session_id)
+                if before_order is not None:
+                    stmt = stmt.where(ChatMessage.message_order < before_order)
+                stmt = stmt.order_by(desc(ChatMessage.message_order)).limit(limit)
                 
                 result = await db_session.execute(stmt)
                 messages = result.scalars().all()
                 
-                return [msg.to_conversation_format() for msg in messages]
+                return [msg.to_conversation_format() for msg in reversed(messages)]
                 
         except Exception as e:
             self.logger.error(f"❌ 从MySQL获取对话历史失败: {e}")
@@ -196,13 +328,13 @@ class PersistentConversationStorage:
             redis_client = await get_redis_client()
             session_key = f"session:{session_id}:messages"
             
-            # 获取最近的消息（Redis中是倒序存储的）
-            messages_data = await redis_client.lrange(session_key, 0, limit - 1)
+            # 获取最近的消息（Redis中按时间顺序追加存储，取表尾即为最新）
+            messages_data = await redis_client.lrange(session_key, -limit, -1)
             
             conversation_history = []
-            for msg_data_str in reversed(messages_data):  # 反转以获得正确的时间顺序
+            for msg_data_str in messages_data:
                 try:
-                    msg_data = json.loads(msg_data_str)
+                    msg_data = decode_redis_message(msg_data_str)
                     conversation_history.append({
                         'type': msg_data['sender_type'],
                         'content': msg_data['message_content'] or '',
@@ -214,10 +346,10 @@ class PersistentConversationStorage:
                             'tool_query_result': msg_data.get('tool_query_result'),
                             'tool_parameters': msg_data.get('tool_parameters'),
                             'message_order': msg_data.get('message_order', 0),
-                            'extra_metadata': json.loads(msg_data['extra_metadata']) if msg_data['extra_metadata'] else {}
+                            'extra_metadata': msg_data.get('extra_metadata') or {}
                         }
                     })
-                except json.JSONDecodeError as e:
+                except (orjson.JSONDecodeError, KeyError) as e:
                     self.logger.error(f"[get_conversation_history_from_redis] JSON decode error: {e}")
                     continue
             
@@ -228,27 +360,62 @@ class PersistentConversationStorage:
             self.logger.error(f"[get_conversation_history_from_redis] Error retrieving from Redis: {e}")
             return []
     
-    async def get_conversation_history(self, session_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+    async def _is_redis_fully_persisted(self, session_id: str) -> bool:
+        """Redis中的消息是否都已持久化到MySQL（比较最新消息序号与已持久化序号）"""
+        redis_client = await get_redis_client()
+        latest_seq, persisted_seq = await redis_client.mget(
+            f"session:{session_id}:msg_seq",
+            f"session:{session_id}:persisted_seq"
+        )
+        return latest_seq is not None and persisted_seq is not None and int(persisted_seq) >= int(latest_seq)
+    
+    async def _get_unpersisted_history_from_redis(self, session_id: str, limit: int) -> List[Dict[str, Any]]:
+        """获取Redis历史；若消息已全部持久化则跳过LRANGE和解码，MySQL结果已包含它们"""
+        if await self._is_redis_fully_persisted(session_id):
+            self.logger.debug(f"[get_conversation_history] Redis messages fully persisted, skipping Redis read: {session_id}")
+            return []
+        return await self.get_conversation_history_from_redis(session_id, limit)
+    
+    async def get_conversation_history(self, session_id: str, limit: int = 50,
+                                       before_order: Optional[int] = None) -> List[Dict[str, Any]]:
         """获取完整对话历史（MySQL + Redis）"""
+        history, _ = await self.get_conversation_history_page(session_id, limit, before_order)
+        return history
+    
+    async def get_conversation_history_page(self, session_id: str, limit: int = 50,
+                                            before_order: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """分页获取对话历史，返回 (消息列表, 下一页游标)
+        
+        before_order: 向前翻页的游标，必须使用上一页返回的下一页游标。
+        游标只取自MySQL中的message_order：Redis消息的序号来自msg_seq计数器，
+        会话清理后会重新计数，与MySQL中同一条消息的序号不一致，不能作为游标。
+        更早的消息都已持久化，翻页时只查询MySQL；没有更早的消息时游标为None
+        """
+        if before_order is not None:
+            messages = await self.get_conversation_history_from_mysql(session_id, limit, before_order)
+            next_before_order = messages[0]['metadata']['message_order'] if len(messages) == limit else None
+            return messages, next_before_order
+        
         try:
-            # 先从MySQL获取历史消息
-            mysql_messages = await self.get_conversation_history_from_mysql(session_id, limit)
+            # 并发获取MySQL历史消息和Redis临时消息，两者互不依赖
+            mysql_messages, redis_messages = await asyncio.gather(
+                self.get_conversation_history_from_mysql(session_id, limit),
+                self._get_unpersisted_history_from_redis(session_id, limit),
+                return_exceptions=True
+            )
+            if isinstance(mysql_messages, Exception):
+                self.logger.error(f"[get_conversation_history] Error fetching from MySQL: {mysql_messages}")
+                mysql_messages = []
+            if isinstance(redis_messages, Exception):
+                self.logger.error(f"[get_conversation_history] Error fetching from Redis: {redis_messages}")
+                redis_messages = []
             self.logger.info(f"[get_conversation_history] Retrieved {len(mysql_messages)} messages from MySQL")
-            
-            # 再从Redis获取当前会话的临时消息
-            redis_messages = await self.get_conversation_history_from_redis(session_id, limit)
             self.logger.info(f"[get_conversation_history] Retrieved {len(redis_messages)} messages from Redis")
             
-            # 合并消息（去重并按时间排序）
-            all_messages = mysql_messages + redis_messages
-            
-            # 按时间戳排序
-            all_messages.sort(key=lambda x: x['timestamp'])
-            
-            # 去重（基于message_id）
+            # 两个列表都已按时间有序，直接归并（O(n)）并基于message_id去重
             seen_ids = set()
             unique_messages = []
-            for msg in all_messages:
+            for msg in heapq.merge(mysql_messages, redis_messages, key=lambda x: x['timestamp']):
                 msg_id = msg['metadata'].get('message_id')
                 if msg_id and msg_id not in seen_ids:
                     seen_ids.add(msg_id)
@@ -260,22 +427,62 @@ class PersistentConversationStorage:
             final_messages = unique_messages[-limit:] if len(unique_messages) > limit else unique_messages
             self.logger.info(f"[get_conversation_history] Returning {len(final_messages)} unique messages (MySQL: {len(mysql_messages)}, Redis: {len(redis_messages)})")
             
-            return final_messages
+            # 已持久化的消息统一使用MySQL中的序号，下一页游标取本页最早的MySQL消息；
+            # 本页全部是未持久化的Redis消息时，从MySQL最新一条开始翻页
+            mysql_orders = {msg['metadata']['message_id']: msg['metadata']['message_order'] for msg in mysql_messages}
+            page_orders = []
+            for msg in final_messages:
+                order = mysql_orders.get(msg['metadata'].get('message_id'))
+                if order is not None:
+                    msg['metadata']['message_order'] = order
+                    page_orders.append(order)
+            if page_orders:
+                oldest_order = min(page_orders)
+                # MySQL结果不足limit条且已全部在本页中时，没有更早的消息
+                has_older = len(mysql_messages) == limit or oldest_order > mysql_messages[0]['metadata']['message_order']
+                next_before_order = oldest_order if has_older else None
+            else:
+                next_before_order = mysql_messages[-1]['metadata']['message_order'] + 1 if mysql_messages else None
+            
+            return final_messages, next_before_order
             
         except Exception as e:
             self.logger.error(f"❌ 获取对话历史失败: {e}")
-            return []
+            return [], None
     
     # ==================== 持久化操作 ====================
     
     async def persist_redis_messages_to_mysql(self, session_id: str) -> bool:
-        """将Redis中的消息持久化到MySQL"""
+        """将Redis中的消息持久化到MySQL（同一会话的持久化串行执行，避免重复累加计数）"""
+        lock = _persist_locks.get(session_id)
+        if lock is None:
+            lock = _persist_locks[session_id] = asyncio.Lock()
+        async with lock:
+            return await self._persist_redis_messages_to_mysql(session_id)
+    
+    async def request_persist(self, session_id: str) -> bool:
+        """请求持久化会话消息
+        
+        后台定时刷写运行时，新消息已在save_message_to_redis中登记，会被合并批量写入，
+        这里直接返回；否则立即持久化。
+        """
+        if _flush_worker is not None and not _flush_worker.done():
+            return True
+        return await self.persist_redis_messages_to_mysql(session_id)
+    
+    async def _persist_redis_messages_to_mysql(self, session_id: str) -> bool:
         try:
             redis_client = await get_redis_client()
             session_key = f"session:{session_id}:messages"
             
-            # 获取所有Redis消息
-            messages_data = await redis_client.lrange(session_key, 0, -1)
+            stats_key = f"session:{session_id}:stat_delta"
+            
+            # 获取所有Redis消息和待同步的会话计数
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.lrange(session_key, 0, -1)
+                pipe.hgetall(stats_key)
+                messages_data, stat_deltas = await pipe.execute()
+            stat_deltas = {field: int(value) for field, value in stat_deltas.items()}
             
             if not messages_data:
                 self.logger.info(f"[persist_redis_messages_to_mysql] No messages to persist for session {session_id}")
@@ -284,77 +491,86 @@ class PersistentConversationStorage:
             async with get_mysql_session() as session:
                 # 获取当前MySQL中该会话的最大消息序号
                 result = await session.execute(
-                    text("SELECT COALESCE(MAX(message_order), 0) FROM chat_messages WHERE session_id = :session_id"),
+                    _SELECT_MAX_MESSAGE_ORDER,
                     {"session_id": session_id}
                 )
                 max_order = result.scalar() or 0
                 
-                # 处理Redis消息（注意Redis中是倒序存储的）
-                messages_to_insert = []
-                persisted_message_ids = []
-                for i, msg_data_str in enumerate(reversed(messages_data)):
+                # 处理Redis消息（按时间顺序存储），已标记持久化的消息直接跳过。
+                # 每条消息只解析一次，解析结果同时用于插入和后续的Redis标记
+                rows_to_insert = []
+                pending_messages = []
+                for index, msg_data_str in enumerate(messages_data):
                     try:
-                        msg_data = json.loads(msg_data_str)
-                        
-                        # 检查消息是否已存在
-                        msg_id = msg_data.get('message_id')
-                        if msg_id:
-                            existing = await session.execute(
-                                text("SELECT message_id FROM chat_messages WHERE message_id = :message_id"),
-                                {"message_id": msg_id}
-                            )
-                            if existing.scalar():
-                                persisted_message_ids.append(msg_id)
-                                continue  # 消息已存在，跳过
+                        msg_data = decode_redis_message(msg_data_str)
+                        if msg_data.get('persisted_to_mysql'):
+                            continue
                         
-                        # 准备插入数据
-                        message = ChatMessage(
-                            message_id=msg_data['message_id'],
-                            session_id=session_id,
-                            sender_type=msg_data['sender_type'],
-                            message_content=msg_data['message_content'],
-                            is_tool_query=msg_data.get('is_tool_query', False),
-                            tool_query_result=msg_data.get('tool_query_result'),
-                            tool_name=msg_data.get('tool_name'),
-                            tool_parameters=msg_data.get('tool_parameters'),
-                            message_order=max_order + i + 1,
-                            created_at=datetime.fromisoformat(msg_data['created_at']),
-                            extra_metadata=msg_data['extra_metadata'] if msg_data['extra_metadata'] else None
-                        )
-                        messages_to_insert.append(message)
-                        persisted_message_ids.append(msg_id)
+                        rows_to_insert.append({
+                            'message_id': msg_data['message_id'],
+                            'session_id': session_id,
+                            'sender_type': msg_data['sender_type'],
+                            'message_content': msg_data['message_content'],
+                            'is_tool_query': msg_data.get('is_tool_query', False),
+                            'tool_query_result': msg_data.get('tool_query_result'),
+                            'tool_name': msg_data.get('tool_name'),
+                            'tool_parameters': msg_data.get('tool_parameters'),
+                            'message_order': max_order + len(rows_to_insert) + 1,
+                            # ISO-8601字符串直接交给MySQL解析，省去逐条fromisoformat及驱动侧的再格式化
+                            'created_at': msg_data['created_at'],
+                            'extra_metadata': orjson.dumps(msg_data['extra_metadata']).decode() if msg_data.get('extra_metadata') is not None else None
+                        })
+                        pending_messages.append((index, msg_data))
                         
-                    except (json.JSONDecodeError, KeyError) as e:
+                    except (orjson.JSONDecodeError, KeyError) as e:
                         self.logger.error(f"[persist_redis_messages_to_mysql] Error processing message: {e}")
                         continue
                 
-                # 批量插入消息
-                if messages_to_insert:
-                    session.add_all(messages_to_insert)
+                # 批量插入消息：INSERT IGNORE 由主键保证幂等，无需预先查询已存在的消息；
+                # 传入参数列表走驱动的executemany，语句本身与批次大小无关，可复用编译缓存
+                if rows_to_insert:
+                    await session.execute(
+                        _INSERT_IGNORE_MESSAGES,
+                        rows_to_insert
+                    )
+                
+                # 在同一事务中同步Redis中累计的会话计数，一次提交
+                if rows_to_insert or any(stat_deltas.values()):
+                    await self._update_session_statistics(
+                        session, session_id, stat_deltas,
+                        # ISO-8601字符串格式一致，字典序即时间顺序
+                        max((row['created_at'] for row in rows_to_insert), default=None)
+                    )
                     await session.commit()
+                    _session_info_cache.pop(session_id, None)
                     
-                    # 更新会话统计
-                    await self._update_session_statistics(session, session_id)
-                    
-                    self.logger.info(f"[persist_redis_messages_to_mysql] Persisted {len(messages_to_insert)} messages to MySQL")
+                    self.logger.info(f"[persist_redis_messages_to_mysql] Persisted {len(rows_to_insert)} messages to MySQL")
                 
                 # 不要立即清理Redis，而是标记已持久化的消息
-                # 为已持久化的消息添加标记，但保留在Redis中以便快速访问
-                for msg_data_str in messages_data:
+                # 为已持久化的消息添加标记，但保留在Redis中以便快速访问。
+                # 原地LSET：新消息RPUSH到表尾不会改变已有下标，消息顺序也保持不变；
+                # 所有更新、已同步计数的扣减和过期时间合并在一个pipeline中
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    for index, msg_data in pending_messages:
+                        msg_data['persisted_to_mysql'] = True
+                        pipe.lset(session_key, index, encode_redis_message(msg_data))
+                    
+                    # 按读取到的值扣减而不是删除，保留期间新消息产生的计数
+                    for field, value in stat_deltas.items():
+                        if value:
+                            pipe.hincrby(stats_key, field, -value)
+                    
+                    # 记录已持久化到的最大消息序号，供读取历史时判断能否跳过Redis
+                    persisted_orders = [msg_data.get('message_order') or 0 for _, msg_data in pending_messages]
+                    if persisted_orders:
+                        pipe.set(f"session:{session_id}:persisted_seq", max(persisted_orders), ex=86400)
+                    
+                    # 延长Redis过期时间到2小时，而不是立即删除
+                    pipe.expire(session_key, 7200)
                     try:
-                        msg_data = json.loads(msg_data_str)
-                        msg_id = msg_data.get('message_id')
-                        if msg_id in persisted_message_ids:
-                            msg_data['persisted_to_mysql'] = True
-                            # 更新Redis中的消息数据
-                            await redis_client.lrem(session_key, 1, msg_data_str)
-                            await redis_client.lpush(session_key, json.dumps(msg_data))
+                        await pipe.execute()
                     except Exception as e:
                         self.logger.error(f"[persist_redis_messages_to_mysql] Error updating Redis message: {e}")
-                        continue
-                
-                # 延长Redis过期时间到2小时，而不是立即删除
-                await redis_client.expire(session_key, 7200)
                 
                 return True
                 
@@ -363,7 +579,19 @@ class PersistentConversationStorage:
             return False
     
     async def cleanup_session(self, session_id: str):
-        """清理会话（持久化并删除Redis数据）"""
+        """清理会话（持久化并删除Redis数据）
+        
+        后台持久化worker运行时只入队并立即返回，由worker完成持久化和清理；
+        否则（如脚本中直接使用）同步执行。
+        """
+        if _cleanup_worker is not None and not _cleanup_worker.done():
+            await _cleanup_queue.put(session_id)
+            self.logger.info(f"会话已加入后台持久化队列: {session_id}")
+            return
+        await self._cleanup_session_now(session_id)
+    
+    async def _cleanup_session_now(self, session_id: str):
+        """立即持久化会话消息并删除Redis数据"""
         try:
             # 持久化消息
             success = await self.persist_redis_messages_to_mysql(session_id)
@@ -371,8 +599,14 @@ class PersistentConversationStorage:
             if success:
                 # 清理Redis数据 - 使用正确的键名
                 redis_client = await get_redis_client()
-                await redis_client.delete(f"session:{session_id}:messages")
-                await redis_client.delete(f"{self.redis_session_prefix}{session_id}")
+                await redis_client.delete(
+                    f"session:{session_id}:messages",
+                    f"session:{session_id}:msg_seq",
+                    f"session:{session_id}:stat_delta",
+                    f"session:{session_id}:persisted_seq",
+                    f"{self.redis_session_prefix}{session_id}"
+                )
+                _session_info_cache.pop(session_id, None)
                 
                 self.logger.info(f"✅ 会话清理完成: {session_id}")
             else:
@@ -395,7 +629,7 @@ class PersistentConversationStorage:
             is_tool_query=True,
             tool_name=tool_name,
             tool_query_result=tool_result,
-            tool_parameters=json.dumps(tool_parameters),
+            tool_parameters=orjson.dumps(tool_parameters).decode(),
             extra_metadata={'tool_execution': True}
         )
     
@@ -405,32 +639,33 @@ class PersistentConversationStorage:
         """获取会话统计信息"""
         try:
             async with get_mysql_session() as db_session:
-                # 获取会话基本信息
-                stmt = select(ChatSession).where(ChatSession.session_id == session_id)
-                result = await db_session.execute(stmt)
-                session = result.scalar_one_or_none()
+                # 一条SQL同时取会话信息和消息统计，只需一次往返
+                result = await db_session.execute(
+                    _SELECT_SESSION_STATISTICS,
+                    {"session_id": session_id}
+                )
+                row = result.first()
                 
-                if not session:
+                if not row:
                     return {}
                 
-                # 获取消息统计
-                msg_stmt = select(
-                    func.count(ChatMessage.message_id).label('total_messages'),
-                    func.sum(func.case([(ChatMessage.sender_type == 'user', 1)], else_=0)).label('user_messages'),
-                    func.sum(func.case([(ChatMessage.sender_type == 'agent', 1)], else_=0)).label('agent_messages'),
-                    func.sum(func.case([(ChatMessage.is_tool_query == True, 1)], else_=0)).label('tool_queries')
-                ).where(ChatMessage.session_id == session_id)
-                
-                msg_result = await db_session.execute(msg_stmt)
-                stats = msg_result.first()
-                
                 return {
-                    'session_info': session.to_dict(),
+                    'session_info': {
+                        'session_id': row.session_id,
+                        'user_name': row.user_name,
+                        'session_title': row.session_title,
+                        'created_at': row.created_at.isoformat() if row.created_at else None,
+                        'last_message_at': row.last_message_at.isoformat() if row.last_message_at else None,
+                        'total_message_count': row.total_message_count,
+                        'user_message_count': row.user_message_count,
+                        'agent_message_count': row.agent_message_count,
+                        'status': row.status
+                    },
                     'message_stats': {
-                        'total_messages': stats.total_messages or 0,
-                        'user_messages': stats.user_messages or 0,
-                        'agent_messages': stats.agent_messages or 0,
-                        'tool_queries': stats.tool_queries or 0
+                        'total_messages': int(row.total_messages or 0),
+                        'user_messages': int(row.user_messages or 0),
+                        'agent_messages': int(row.agent_messages or 0),
+                        'tool_queries': int(row.tool_queries or 0)
                     }
                 }
                 
@@ -438,45 +673,192 @@ class PersistentConversationStorage:
             self.logger.error(f"❌ 获取会话统计失败: {e}")
             return {}
 
-    async def _update_session_statistics(self, db_session, session_id: str):
-        """更新会话统计信息"""
-        try:
-            # 计算消息统计
-            msg_stats = await db_session.execute(
-                text("""
-                    SELECT 
-                        COUNT(*) as total_count,
-                        SUM(CASE WHEN sender_type = 'user' THEN 1 ELSE 0 END) as user_count,
-                        SUM(CASE WHEN sender_type = 'agent' THEN 1 ELSE 0 END) as agent_count,
-                        MAX(created_at) as last_message_time
-                    FROM chat_messages 
-                    WHERE session_id = :session_id
-                """),
-                {"session_id": session_id}
-            )
-            stats = msg_stats.first()
-            
-            if stats:
-                # 更新会话表
-                await db_session.execute(
-                    text("""
-                        UPDATE chat_sessions 
-                        SET 
-                            total_message_count = :total_count,
-                            user_message_count = :user_count,
-                            agent_message_count = :agent_count,
-                            last_message_at = :last_message_time
-                        WHERE session_id = :session_id
-                    """),
-                    {
-                        "session_id": session_id,
-                        "total_count": stats.total_count or 0,
-                        "user_count": stats.user_count or 0,
-                        "agent_count": stats.agent_count or 0,
-                        "last_message_time": stats.last_message_time or datetime.now()
-                    }
-                )
-                await db_session.commit()
+    async def _update_session_statistics(self, db_session, session_id: str,
+                                         stat_deltas: Dict[str, int],
+                                         last_message_time: Optional[str] = None):
+        """更新会话统计信息（不提交，由调用方所在事务统一提交）
+        
+        计数由save_message_to_redis在Redis中增量累计，这里只做加法更新，
+        不再对整个会话做COUNT/SUM扫描。
+        last_message_time为ISO-8601字符串，转换为datetime绑定，确保MySQL按DATETIME而非字符串比较；
+        last_message_at为NULL时GREATEST返回NULL，由COALESCE回退为本批最新消息时间
+        """
+        await db_session.execute(
+            _UPDATE_SESSION_STATS,
+            {
+                "session_id": session_id,
+                "total_delta": stat_deltas.get('total_message_count', 0),
+                "user_delta": stat_deltas.get('user_message_count', 0),
+                "agent_delta": stat_deltas.get('agent_message_count', 0),
+                "last_message_time": datetime.fromisoformat(last_message_time) if last_message_time else None
+            }
+        )
+
+# ==================== 旧格式迁移 ====================
+
+async def migrate_legacy_redis_messages() -> int:
+    """把旧版格式的Redis消息列表转换为当前格式，返回转换的会话数
+    
+    旧版用LPUSH写入JSON对象（最新消息在表头），当前版本用RPUSH写入紧凑数组（最新消息在表尾），
+    持久化按下标LSET标记消息。未转换的旧列表会被倒序读取并标记错位置，因此服务启动时
+    （开始写入新消息之前）统一转换。旧版消息都在表头，新格式消息都在表尾，转换时只反转旧版部分。
+    """
+    redis_client = await get_redis_client()
+    migrated = 0
+    async for session_key in redis_client.scan_iter(match="session:*:messages", count=500):
+        async with redis_client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(session_key)
+                raw_messages = await pipe.lrange(session_key, 0, -1)
+                legacy_messages, current_messages = [], []
+                for raw in raw_messages:
+                    # 当前格式是JSON数组，旧版是JSON对象
+                    (legacy_messages if raw.startswith('{') else current_messages).append(raw)
+                if not legacy_messages:
+                    await pipe.unwatch()
+                    continue
+                
+                ttl = await pipe.ttl(session_key)
+                converted = [
+                    encode_redis_message(decode_redis_message(raw)) for raw in reversed(legacy_messages)
+                ] + current_messages
                 
+                pipe.multi()
+                pipe.delete(session_key)
+                pipe.rpush(session_key, *converted)
+                if ttl > 0:
+                    pipe.expire(session_key, ttl)
+                await pipe.execute()
+                migrated += 1
+            except WatchError:
+                # 迁移期间有新消息写入（其他进程已开始服务），该进程写入的是新格式，下次启动再转换
+                logger.warning(f"⚠️ 会话消息列表迁移期间被修改，已跳过: {session_key}")
+            except orjson.JSONDecodeError as e:
+                logger.error(f"❌ 会话消息列表迁移失败: {session_key} - {e}")
+    
+    if migrated:
+        logger.info(f"✅ 已将 {migrated} 个会话的Redis消息列表转换为当前格式")
+    return migrated
+
+# ==================== 后台持久化 ====================
+
+# 定时批量刷写配置：每PERSIST_FLUSH_INTERVAL秒检查一次，会话累积消息达到
+# PERSIST_FLUSH_BULK_SIZE条或最早的未持久化消息等待超过PERSIST_FLUSH_MAX_DELAY秒时刷写
+PERSIST_FLUSH_INTERVAL = 0.1
+PERSIST_FLUSH_MAX_DELAY = 1.0
+PERSIST_FLUSH_BULK_SIZE = 50
+# 同时持久化的会话数上限（应不超过MySQL连接池大小，避免关闭时一次性耗尽连接池）
+PERSIST_FLUSH_CONCURRENCY = 8
+# 单个会话持久化的超时时间（秒），避免某次MySQL调用挂起拖住整批刷写和应用关闭
+PERSIST_FLUSH_TIMEOUT = 5.0
+
+# 待刷写会话：session_id -> [首条未持久化消息的时间, 累积消息数]
+_dirty_sessions: Dict[str, List[float]] = {}
+_flush_worker: Optional[asyncio.Task] = None
+
+# 每个会话的持久化锁（不再使用时自动回收）
+_persist_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _mark_session_dirty(session_id: str):
+    """登记有新消息待持久化的会话（仅在定时刷写运行时登记）"""
+    if _flush_worker is None or _flush_worker.done():
+        return
+    entry = _dirty_sessions.get(session_id)
+    if entry is None:
+        _dirty_sessions[session_id] = [time.monotonic(), 1]
+    else:
+        entry[1] += 1
+
+async def _flush_sessions(storage: PersistentConversationStorage, session_ids: List[str]):
+    """批量持久化指定会话（并发数受限），失败的会话重新登记等待下次重试"""
+    semaphore = asyncio.Semaphore(PERSIST_FLUSH_CONCURRENCY)
+    
+    async def _persist(session_id: str):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(
+                    storage.persist_redis_messages_to_mysql(session_id),
+                    timeout=PERSIST_FLUSH_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                # 超时的会话消息仍保留在Redis中，不影响其他会话继续持久化
+                logger.warning(f"⚠️ 会话持久化超时（{PERSIST_FLUSH_TIMEOUT}秒）: {session_id}")
+                return False
+    
+    results = await asyncio.gather(
+        *(_persist(session_id) for session_id in session_ids),
+        return_exceptions=True
+    )
+    for session_id, result in zip(session_ids, results):
+        if result is not True:
+            logger.warning(f"⚠️ 定时持久化失败，稍后重试: {session_id}")
+            _dirty_sessions.setdefault(session_id, [time.monotonic(), 0])
+
+async def _run_flush_worker(storage: PersistentConversationStorage):
+    """定时把多次小的消息写入合并为一次批量持久化"""
+    while True:
+        await asyncio.sleep(PERSIST_FLUSH_INTERVAL)
+        now = time.monotonic()
+        due = [
+            session_id for session_id, (since, count) in _dirty_sessions.items()
+            if count >= PERSIST_FLUSH_BULK_SIZE or now - since >= PERSIST_FLUSH_MAX_DELAY
+        ]
+        if not due:
+            continue
+        for session_id in due:
+            del _dirty_sessions[session_id]
+        await _flush_sessions(storage, due)
+
+# 待清理会话队列（有界，队列满时cleanup_session会等待，形成背压）
+_cleanup_queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=1000)
+_cleanup_worker: Optional[asyncio.Task] = None
+
+async def _run_cleanup_worker(storage: PersistentConversationStorage):
+    """消费待清理会话队列，逐个持久化并清理Redis数据"""
+    while True:
+        session_id = await _cleanup_queue.get()
+        try:
+            await storage._cleanup_session_now(session_id)
         except Exception as e:
-            self.logger.error(f"[_update_session_statistics] Error updating session statistics: {e}") 
\ No newline at end of file
+            logger.error(f"❌ 后台会话清理失败: {session_id} - {e}")
+        finally:
+            _cleanup_queue.task_done()
+
+def start_persist_worker():
+    """启动后台持久化worker和定时刷写（应用启动时调用）"""
+    global _cleanup_worker, _flush_worker
+    storage = PersistentConversationStorage()
+    if _cleanup_worker is None or _cleanup_worker.done():
+        _cleanup_worker = asyncio.create_task(_run_cleanup_worker(storage))
+    if _flush_worker is None or _flush_worker.done():
+        _flush_worker = asyncio.create_task(_run_flush_worker(storage))
+    logger.info("✅ 后台持久化worker已启动")
+
+async def stop_persist_worker(timeout: float = 30.0):
+    """停止后台持久化worker，先刷写待持久化会话并等待队列处理完毕（应用关闭时调用）"""
+    global _cleanup_worker, _flush_worker
+    if _flush_worker is not None:
+        _flush_worker.cancel()
+        try:
+            await _flush_worker
+        except asyncio.CancelledError:
+            pass
+        _flush_worker = None
+        if _dirty_sessions:
+            pending = list(_dirty_sessions)
+            _dirty_sessions.clear()
+            await _flush_sessions(PersistentConversationStorage(), pending)
+    
+    if _cleanup_worker is None:
+        return
+    try:
+        await asyncio.wait_for(_cleanup_queue.join(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ 后台持久化队列未在{timeout}秒内处理完，剩余 {_cleanup_queue.qsize()} 个会话")
+    _cleanup_worker.cancel()
+    try:
+        await _cleanup_worker
+    except asyncio.CancelledError:
+        pass
+    _cleanup_worker = None
+    logger.info("后台持久化worker已停止")
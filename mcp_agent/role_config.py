@@ -4,16 +4,38 @@
 """
 
 import os
-import json
-import yaml
-from typing import Dict, Any, List, Optional
+import itertools
+import orjson
+from types import MappingProxyType
+from typing import Dict, Any, List, Mapping, Optional, Tuple
 from pathlib import Path
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, field
 import logging
 
-@dataclass
+def _load_yaml(stream) -> Any:
+    """解析YAML配置
+    
+    PyYAML仅在确实存在YAML配置时才导入；优先使用libyaml的C实现解析器，不可用时回退到纯Python实现
+    """
+    import yaml
+    return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+# 项目根目录（角色配置中的相对路径均以此为基准）
+_PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+# 支持的角色配置文件格式（按查找优先级排列）
+CONFIG_FILE_EXTENSIONS = ('.json', '.yaml', '.yml')
+
+# 扫描YAML配置时只解析文件头部的行数
+YAML_HEADER_LINES = 16
+
+@dataclass(slots=True, frozen=True)
 class RoleConfig:
-    """角色配置数据类"""
+    """角色配置数据类
+    
+    实例不可变：initial_mood以只读映射保存，不参与哈希（其余字段已足以区分配置），
+    因此配置对象可以安全共享，也可以作为字典键或放入集合
+    """
     role_id: str
     role_name: str
     age: int
@@ -21,11 +43,25 @@ class RoleConfig:
     description: str
     l0_prompt_path: str
     character_plot_folder: str
-    initial_mood: Dict[str, Any]
+    initial_mood: Mapping[str, Any] = field(hash=False)
     life_plot_outline_path: Optional[str] = None
     
+    def __post_init__(self):
+        # 复制一份再包装为只读映射，调用方后续修改传入的字典不会影响配置
+        object.__setattr__(self, "initial_mood", MappingProxyType(dict(self.initial_mood)))
+    
     def to_dict(self) -> Dict[str, Any]:
-        return asdict(self)
+        return {
+            "role_id": self.role_id,
+            "role_name": self.role_name,
+            "age": self.age,
+            "profession": self.profession,
+            "description": self.description,
+            "l0_prompt_path": self.l0_prompt_path,
+            "character_plot_folder": self.character_plot_folder,
+            "initial_mood": dict(self.initial_mood),
+            "life_plot_outline_path": self.life_plot_outline_path
+        }
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'RoleConfig':
@@ -43,63 +79,99 @@ class RoleConfigManager:
             self.config_dir = Path(config_dir)
         else:
             # 默认配置目录：项目根目录下的 role_configs
-            project_root = Path(__file__).parent.parent
-            self.config_dir = project_root / "role_configs"
+            self.config_dir = _PROJECT_ROOT / "role_configs"
         
         # 确保配置目录存在
         self.config_dir.mkdir(exist_ok=True)
         
-        # 缓存已加载的角色配置
-        self._role_cache: Dict[str, RoleConfig] = {}
+        # 缓存已加载的角色配置：{role_id: (配置文件mtime_ns, RoleConfig)}，文件变化时重新加载
+        self._role_cache: Dict[str, Tuple[int, RoleConfig]] = {}
+        
+        # 配置目录快照：(目录mtime_ns, {文件名: 配置文件路径})，目录变化时重新扫描
+        self._dir_snapshot: Optional[Tuple[int, Dict[str, Path]]] = None
+        
+        # 角色显示信息缓存：{role_id: (生成时的RoleConfig, 显示信息)}，配置重新加载后重新生成
+        self._display_cache: Dict[str, Tuple[RoleConfig, Dict[str, Any]]] = {}
         
         self.logger.info(f"角色配置管理器初始化完成，配置目录: {self.config_dir}")
     
-    def get_available_roles(self) -> List[str]:
-        """获取所有可用的角色ID"""
+    def get_available_roles(self, verify: bool = False) -> List[str]:
+        """获取所有可用的角色ID
+        
+        配置文件以 {role_id}{ext} 命名，默认直接由文件名得到角色ID而不解析文件内容；
+        对文件名与role_id不一致的旧配置，可传入 verify=True 逐个解析文件读取role_id。
+        """
         try:
-            roles = []
+            if not verify:
+                # 复用目录快照，由文件名得到角色ID
+                return sorted({os.path.splitext(name)[0] for name in self._scan_config_dir()})  # 去重并排序
+            
+            roles = set()
             
             # 扫描配置文件
             for config_file in self.config_dir.glob("*.json"):
                 try:
-                    with open(config_file, 'r', encoding='utf-8') as f:
-                        config_data = json.load(f)
+                    with open(config_file, 'rb') as f:
+                        config_data = orjson.loads(f.read())
                         if 'role_id' in config_data:
-                            roles.append(config_data['role_id'])
+                            roles.add(config_data['role_id'])
                 except Exception as e:
                     self.logger.warning(f"读取角色配置文件失败: {config_file} - {e}")
             
             # 扫描YAML配置文件
             for config_file in self.config_dir.glob("*.yaml"):
                 try:
-                    with open(config_file, 'r', encoding='utf-8') as f:
-                        config_data = yaml.safe_load(f)
-                        if 'role_id' in config_data:
-                            roles.append(config_data['role_id'])
+                    role_id = self._read_yaml_role_id(config_file)
+                    if role_id:
+                        roles.add(role_id)
                 except Exception as e:
                     self.logger.warning(f"读取角色配置文件失败: {config_file} - {e}")
             
+            roles = sorted(roles)  # 去重并排序
             self.logger.info(f"找到 {len(roles)} 个可用角色: {roles}")
-            return sorted(list(set(roles)))  # 去重并排序
+            return roles
             
         except Exception as e:
             self.logger.error(f"获取可用角色失败: {e}")
             return []
     
+    def _read_yaml_role_id(self, config_file: Path) -> Optional[str]:
+        """读取YAML配置中的role_id
+        
+        role_id 通常位于文件开头，先只解析前 YAML_HEADER_LINES 行；
+        头部解析失败或未包含role_id时，再回退到完整解析
+        """
+        with open(config_file, 'r', encoding='utf-8') as f:
+            head = "".join(itertools.islice(f, YAML_HEADER_LINES))
+            try:
+                config_data = _load_yaml(head)
+            except Exception:
+                config_data = None
+            
+            if not isinstance(config_data, dict) or 'role_id' not in config_data:
+                f.seek(0)
+                config_data = _load_yaml(f)
+        
+        if isinstance(config_data, dict):
+            return config_data.get('role_id')
+        return None
+    
     def load_role_config(self, role_id: str) -> Optional[RoleConfig]:
         """加载指定角色的配置"""
         try:
-            # 检查缓存
-            if role_id in self._role_cache:
-                self.logger.debug(f"从缓存加载角色配置: {role_id}")
-                return self._role_cache[role_id]
-            
             # 查找配置文件
             config_file = self._find_role_config_file(role_id)
             if not config_file:
                 self.logger.warning(f"未找到角色配置文件: {role_id}")
                 return None
             
+            # 检查缓存，文件未修改时跳过解析和验证
+            file_mtime = config_file.stat().st_mtime_ns
+            cached = self._role_cache.get(role_id)
+            if cached is not None and cached[0] == file_mtime:
+                self.logger.debug(f"从缓存加载角色配置: {role_id}")
+                return cached[1]
+            
             # 读取配置文件
             config_data = self._read_config_file(config_file)
             if not config_data:
@@ -119,7 +191,7 @@ class RoleConfigManager:
                 return None
             
             # 缓存配置
-            self._role_cache[role_id] = role_config
+            self._role_cache[role_id] = (file_mtime, role_config)
             
             self.logger.info(f"成功加载角色配置: {role_id} - {role_config.role_name}")
             return role_config
@@ -128,14 +200,31 @@ class RoleConfigManager:
             self.logger.error(f"加载角色配置失败: {role_id} - {e}")
             return None
     
+    def _scan_config_dir(self) -> Dict[str, Path]:
+        """扫描配置目录，返回 {文件名: 配置文件路径}
+        
+        使用一次 os.scandir 遍历目录，结果按目录mtime缓存，目录未变化时只需一次stat()
+        """
+        mtime = self.config_dir.stat().st_mtime_ns
+        if self._dir_snapshot is not None and self._dir_snapshot[0] == mtime:
+            return self._dir_snapshot[1]
+        
+        with os.scandir(self.config_dir) as it:
+            files = {
+                entry.name: Path(entry.path)
+                for entry in it
+                if os.path.splitext(entry.name)[1] in CONFIG_FILE_EXTENSIONS and entry.is_file()
+            }
+        
+        self._dir_snapshot = (mtime, files)
+        return files
+    
     def _find_role_config_file(self, role_id: str) -> Optional[Path]:
         """查找角色配置文件"""
-        # 支持的文件格式
-        extensions = ['.json', '.yaml', '.yml']
-        
-        for ext in extensions:
-            config_file = self.config_dir / f"{role_id}{ext}"
-            if config_file.exists():
+        files = self._scan_config_dir()
+        for ext in CONFIG_FILE_EXTENSIONS:
+            config_file = files.get(f"{role_id}{ext}")
+            if config_file:
                 return config_file
         
         return None
@@ -143,14 +232,15 @@ class RoleConfigManager:
     def _read_config_file(self, config_file: Path) -> Optional[Dict[str, Any]]:
         """读取配置文件"""
         try:
-            with open(config_file, 'r', encoding='utf-8') as f:
-                if config_file.suffix.lower() == '.json':
-                    return json.load(f)
-                elif config_file.suffix.lower() in ['.yaml', '.yml']:
-                    return yaml.safe_load(f)
-                else:
-                    self.logger.error(f"不支持的配置文件格式: {config_file}")
-                    return None
+            if config_file.suffix.lower() == '.json':
+                with open(config_file, 'rb') as f:
+                    return orjson.loads(f.read())
+            elif config_file.suffix.lower() in ['.yaml', '.yml']:
+                with open(config_file, 'r', encoding='utf-8') as f:
+                    return _load_yaml(f)
+            else:
+                self.logger.error(f"不支持的配置文件格式: {config_file}")
+                return None
         except Exception as e:
             self.logger.error(f"读取配置文件失败: {config_file} - {e}")
             return None
@@ -178,7 +268,7 @@ class RoleConfigManager:
     
     def _validate_role_files(self, role_config: RoleConfig) -> bool:
         """验证角色相关文件是否存在"""
-        project_root = Path(__file__).parent.parent
+        project_root = _PROJECT_ROOT
         
         # 验证L0提示词文件
         l0_path = project_root / role_config.l0_prompt_path
@@ -205,17 +295,20 @@ class RoleConfigManager:
         try:
             config_file = self.config_dir / f"{role_config.role_id}.{file_format}"
             
-            with open(config_file, 'w', encoding='utf-8') as f:
-                if file_format == 'json':
-                    json.dump(role_config.to_dict(), f, ensure_ascii=False, indent=2)
-                elif file_format in ['yaml', 'yml']:
+            if file_format == 'json':
+                with open(config_file, 'wb') as f:
+                    f.write(orjson.dumps(role_config.to_dict(), option=orjson.OPT_INDENT_2))
+            elif file_format in ['yaml', 'yml']:
+                import yaml
+                with open(config_file, 'w', encoding='utf-8') as f:
                     yaml.dump(role_config.to_dict(), f, allow_unicode=True, default_flow_style=False)
-                else:
-                    self.logger.error(f"不支持的保存格式: {file_format}")
-                    return False
+            else:
+                self.logger.error(f"不支持的保存格式: {file_format}")
+                return False
             
             # 更新缓存
-            self._role_cache[role_config.role_id] = role_config
+            self._role_cache[role_config.role_id] = (config_file.stat().st_mtime_ns, role_config)
+            self._dir_snapshot = None
             
             self.logger.info(f"角色配置保存成功: {role_config.role_id}")
             return True
@@ -245,12 +338,19 @@ class RoleConfigManager:
         )
     
     def get_role_display_info(self, role_id: str) -> Optional[Dict[str, Any]]:
-        """获取角色的显示信息（用于选择界面）"""
+        """获取角色的显示信息（用于选择界面）
+        
+        显示信息随角色配置缓存，配置文件未变化时直接返回同一个dict（调用方不应修改）
+        """
         role_config = self.load_role_config(role_id)
         if not role_config:
             return None
         
-        return {
+        cached = self._display_cache.get(role_id)
+        if cached is not None and cached[0] is role_config:
+            return cached[1]
+        
+        display_info = {
             "role_id": role_config.role_id,
             "role_name": role_config.role_name,
             "age": role_config.age,
@@ -259,6 +359,17 @@ class RoleConfigManager:
             "mood_tags": role_config.initial_mood.get("my_tags", "未知"),
             "mood_intensity": role_config.initial_mood.get("my_intensity", 0)
         }
+        self._display_cache[role_id] = (role_config, display_info)
+        return display_info
+    
+    def get_available_roles_display_info(self) -> List[Dict[str, Any]]:
+        """获取所有可用角色的显示信息列表（跳过无法加载的角色）"""
+        role_info = []
+        for role_id in self.get_available_roles():
+            info = self.get_role_display_info(role_id)
+            if info:
+                role_info.append(info)
+        return role_info
     
     def initialize_default_roles(self):
         """初始化默认角色配置（首次运行时）"""
@@ -319,4 +430,8 @@ def get_available_roles() -> List[str]:
 
 def get_role_display_info(role_id: str) -> Optional[Dict[str, Any]]:
     """快捷函数：获取角色显示信息"""
-    return get_role_config_manager().get_role_display_info(role_id) 
\ No newline at end of file
+    return get_role_config_manager().get_role_display_info(role_id)
+
+def get_available_roles_display_info() -> List[Dict[str, Any]]:
+    """快捷函数：获取所有可用角色的显示信息"""
+    return get_role_config_manager().get_available_roles_display_info() 
\ No newline at end of file
@@ -5,13 +5,64 @@
 
 import json
 import logging
-from typing import Dict, Any, Optional, List
+import time
+from typing import Dict, Any, Optional, List, Tuple
 from dataclasses import dataclass
 from pathlib import Path
+from sqlalchemy import text, bindparam, JSON
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+# 角色表SQL语句（模块级预编译，避免每次调用重新构建）
+_ROLE_COLUMNS = "role_id, role_name, L0_prompt_path, L1_prompt_path, mood, age, current_life_stage_id, current_plot_segment_id, current_materials_id, created_at, updated_at"
+
+_CREATE_ROLE_TABLE = text("""
+    CREATE TABLE IF NOT EXISTS role_details (
+        role_id VARCHAR(64) PRIMARY KEY COMMENT '角色ID',
+        role_name VARCHAR(255) NOT NULL COMMENT '角色名称',
+        L0_prompt_path VARCHAR(512) NOT NULL COMMENT 'L0提示词文件路径',
+        L1_prompt_path VARCHAR(512) NOT NULL COMMENT 'L1提示词文件路径',
+        mood JSON NOT NULL COMMENT '角色情绪状态',
+        age INT COMMENT '年龄',
+        current_life_stage_id VARCHAR(64) COMMENT '当前生活阶段ID',
+        current_plot_segment_id VARCHAR(64) COMMENT '当前剧情段落ID',
+        current_materials_id VARCHAR(64) COMMENT '当前材料ID',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+        INDEX idx_role_name (role_name)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='角色详细信息表';
+""")
+
+_INSERT_ROLE = text("""
+    INSERT INTO role_details (role_id, role_name, L0_prompt_path, L1_prompt_path, mood, age, current_life_stage_id, current_plot_segment_id, current_materials_id)
+    VALUES (:role_id, :role_name, :L0_prompt_path, :L1_prompt_path, :mood, :age, :current_life_stage_id, :current_plot_segment_id, :current_materials_id)
+""")
+
+# mood列声明为JSON类型，由SQLAlchemy结果处理直接解码为字典
+_SELECT_ROLE = text(
+    f"SELECT {_ROLE_COLUMNS} FROM role_details WHERE role_id = :role_id"
+).columns(mood=JSON)
+
+_SELECT_ROLES_BY_IDS = text(
+    f"SELECT {_ROLE_COLUMNS} FROM role_details WHERE role_id IN :role_ids"
+).bindparams(bindparam("role_ids", expanding=True)).columns(mood=JSON)
+
+_SELECT_ALL_ROLES = text(
+    f"SELECT {_ROLE_COLUMNS} FROM role_details ORDER BY created_at DESC"
+).columns(mood=JSON)
+
+_UPDATE_ROLE_MOOD = text("UPDATE role_details SET mood = :mood WHERE role_id = :role_id")
+
+# 进程内角色情绪短期缓存：{role_id: (过期时间, RoleMood)}，频繁读取时省去Redis往返和解析。
+# 本进程内写入情绪时立即失效；其他途径写入Redis的情绪最多延迟ROLE_MOOD_CACHE_TTL秒可见
+ROLE_MOOD_CACHE_TTL = 1.0
+_role_mood_cache: Dict[str, Tuple[float, 'RoleMood']] = {}
+
+def invalidate_role_mood_cache(role_id: str):
+    """使指定角色的进程内情绪缓存失效"""
+    _role_mood_cache.pop(role_id, None)
+
+@dataclass(slots=True, frozen=True)
 class RoleMood:
     """角色情绪状态"""
     my_valence: float  # 情感效价 (-1.0 到 1.0)
@@ -51,7 +102,7 @@ class RoleMood:
         """转换为JSON字符串"""
         return json.dumps(self.to_dict(), ensure_ascii=False)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class RoleDetail:
     """角色详细信息"""
     role_id: str
@@ -73,7 +124,7 @@ class RoleDetail:
             "role_name": self.role_name,
             "L0_prompt_path": self.L0_prompt_path,
             "L1_prompt_path": self.L1_prompt_path,
-            "mood": self.mood.to_json(),
+            "mood": self.mood.to_dict(),
             "age": self.age,
             "current_life_stage_id": self.current_life_stage_id,
             "current_plot_segment_id": self.current_plot_segment_id,
@@ -91,28 +142,10 @@ class RoleDetailManager:
     async def create_role_table(self):
         """创建角色详细信息表"""
         from database_config import get_mysql_session
-        from sqlalchemy import text
         
         try:
             async with get_mysql_session() as session:
-                create_table_sql = """
-                CREATE TABLE IF NOT EXISTS role_details (
-                    role_id VARCHAR(64) PRIMARY KEY COMMENT '角色ID',
-                    role_name VARCHAR(255) NOT NULL COMMENT '角色名称',
-                    L0_prompt_path VARCHAR(512) NOT NULL COMMENT 'L0提示词文件路径',
-                    L1_prompt_path VARCHAR(512) NOT NULL COMMENT 'L1提示词文件路径',
-                    mood JSON NOT NULL COMMENT '角色情绪状态',
-                    age INT COMMENT '年龄',
-                    current_life_stage_id VARCHAR(64) COMMENT '当前生活阶段ID',
-                    current_plot_segment_id VARCHAR(64) COMMENT '当前剧情段落ID',
-                    current_materials_id VARCHAR(64) COMMENT '当前材料ID',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
-                    INDEX idx_role_name (role_name)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='角色详细信息表';
-                """
-                
-                await session.execute(text(create_table_sql))
+                await session.execute(_CREATE_ROLE_TABLE)
                 await session.commit()
                 self.logger.info("✅ 角色详细信息表创建成功")
                 
@@ -123,26 +156,10 @@ class RoleDetailManager:
     async def create_role(self, role_detail: RoleDetail) -> bool:
         """创建角色"""
         from database_config import get_mysql_session
-        from sqlalchemy import text
         
         try:
             async with get_mysql_session() as session:
-                insert_sql = """
-                INSERT INTO role_details (role_id, role_name, L0_prompt_path, L1_prompt_path, mood, age, current_life_stage_id, current_plot_segment_id, current_materials_id)
-                VALUES (:role_id, :role_name, :L0_prompt_path, :L1_prompt_path, :mood, :age, :current_life_stage_id, :current_plot_segment_id, :current_materials_id)
-                """
-                
-                await session.execute(text(insert_sql), {
-                    "role_id": role_detail.role_id,
-                    "role_name": role_detail.role_name,
-                    "L0_prompt_path": role_detail.L0_prompt_path,
-                    "L1_prompt_path": role_detail.L1_prompt_path,
-                    "mood": role_detail.mood.to_json(),
-                    "age": role_detail.age,
-                    "current_life_stage_id": role_detail.current_life_stage_id,
-                    "current_plot_segment_id": role_detail.current_plot_segment_id,
-                    "current_materials_id": role_detail.current_materials_id
-                })
+                await session.execute(_INSERT_ROLE, self._role_insert_params(role_detail))
                 
                 await session.commit()
                 self.logger.info(f"✅ 角色创建成功: {role_detail.role_name} ({role_detail.role_id})")
@@ -152,58 +169,97 @@ class RoleDetailManager:
             self.logger.error(f"❌ 角色创建失败: {e}")
             return False
     
+    async def create_roles_bulk(self, roles: List[RoleDetail]) -> int:
+        """批量创建角色（单个会话内一次executemany），返回创建数量"""
+        from database_config import get_mysql_session
+        
+        if not roles:
+            return 0
+        
+        try:
+            async with get_mysql_session() as session:
+                await session.execute(_INSERT_ROLE, [self._role_insert_params(role) for role in roles])
+                
+                await session.commit()
+                self.logger.info(f"✅ 批量创建角色成功: {[role.role_id for role in roles]}")
+                return len(roles)
+                
+        except Exception as e:
+            self.logger.error(f"❌ 批量创建角色失败: {e}")
+            return 0
+    
+    @staticmethod
+    def _role_insert_params(role_detail: RoleDetail) -> Dict[str, Any]:
+        """构造角色INSERT语句参数"""
+        return {
+            "role_id": role_detail.role_id,
+            "role_name": role_detail.role_name,
+            "L0_prompt_path": role_detail.L0_prompt_path,
+            "L1_prompt_path": role_detail.L1_prompt_path,
+            "mood": role_detail.mood.to_json(),
+            "age": role_detail.age,
+            "current_life_stage_id": role_detail.current_life_stage_id,
+            "current_plot_segment_id": role_detail.current_plot_segment_id,
+            "current_materials_id": role_detail.current_materials_id
+        }
+    
+    @staticmethod
+    def _row_to_role_detail(row) -> RoleDetail:
+        """将查询行转换为RoleDetail（mood列已由JSON类型解码为字典）"""
+        return RoleDetail(
+            role_id=row[0],
+            role_name=row[1],
+            L0_prompt_path=row[2],
+            L1_prompt_path=row[3],
+            mood=RoleMood.from_dict(row[4]),
+            age=row[5],
+            current_life_stage_id=row[6],
+            current_plot_segment_id=row[7],
+            current_materials_id=row[8],
+            created_at=str(row[9]) if row[9] else None,
+            updated_at=str(row[10]) if row[10] else None
+        )
+    
     async def get_role(self, role_id: str) -> Optional[RoleDetail]:
         """获取角色信息"""
         from database_config import get_mysql_session
-        from sqlalchemy import text
         
         try:
             async with get_mysql_session() as session:
-                select_sql = """
-                SELECT role_id, role_name, L0_prompt_path, L1_prompt_path, mood, age, current_life_stage_id, current_plot_segment_id, current_materials_id, created_at, updated_at
-                FROM role_details WHERE role_id = :role_id
-                """
-                
-                result = await session.execute(text(select_sql), {"role_id": role_id})
+                result = await session.execute(_SELECT_ROLE, {"role_id": role_id})
                 row = result.fetchone()
                 
                 if row:
-                    mood = RoleMood.from_json(row[4])
-                    return RoleDetail(
-                        role_id=row[0],
-                        role_name=row[1],
-                        L0_prompt_path=row[2],
-                        L1_prompt_path=row[3],
-                        mood=mood,
-                        age=row[5],
-                        current_life_stage_id=row[6],
-                        current_plot_segment_id=row[7],
-                        current_materials_id=row[8],
-                        created_at=str(row[9]) if row[9] else None,
-                        updated_at=str(row[10]) if row[10] else None
-                    )
+                    return self._row_to_role_detail(row)
                 return None
                 
         except Exception as e:
             self.logger.error(f"❌ 获取角色信息失败: {e}")
             return None
     
+    async def get_roles(self, role_ids: List[str]) -> Dict[str, RoleDetail]:
+        """批量获取角色信息（单条IN查询），返回 {role_id: RoleDetail}"""
+        from database_config import get_mysql_session
+        
+        if not role_ids:
+            return {}
+        
+        async with get_mysql_session() as session:
+            result = await session.execute(_SELECT_ROLES_BY_IDS, {"role_ids": list(role_ids)})
+            return {row[0]: self._row_to_role_detail(row) for row in result.fetchall()}
+    
     async def update_role_mood(self, role_id: str, mood: RoleMood) -> bool:
         """更新角色情绪状态"""
         from database_config import get_mysql_session
-        from sqlalchemy import text
         
         try:
             async with get_mysql_session() as session:
-                update_sql = """
-                UPDATE role_details SET mood = :mood WHERE role_id = :role_id
-                """
-                
-                result = await session.execute(text(update_sql), {
+                result = await session.execute(_UPDATE_ROLE_MOOD, {
                     "mood": mood.to_json(),
                     "role_id": role_id
                 })
                 await session.commit()
+                invalidate_role_mood_cache(role_id)
                 
                 if result.rowcount > 0:
                     self.logger.info(f"✅ 角色情绪状态更新成功: {role_id}")
@@ -219,44 +275,22 @@ class RoleDetailManager:
     async def list_roles(self) -> List[RoleDetail]:
         """获取所有角色列表"""
         from database_config import get_mysql_session
-        from sqlalchemy import text
         
         try:
             async with get_mysql_session() as session:
-                select_sql = """
-                SELECT role_id, role_name, L0_prompt_path, L1_prompt_path, mood, age, current_life_stage_id, current_plot_segment_id, current_materials_id, created_at, updated_at
-                FROM role_details ORDER BY created_at DESC
-                """
-                
-                result = await session.execute(text(select_sql))
+                result = await session.execute(_SELECT_ALL_ROLES)
                 rows = result.fetchall()
                 
-                roles = []
-                for row in rows:
-                    mood = RoleMood.from_json(row[4])
-                    roles.append(RoleDetail(
-                        role_id=row[0],
-                        role_name=row[1],
-                        L0_prompt_path=row[2],
-                        L1_prompt_path=row[3],
-                        mood=mood,
-                        age=row[5],
-                        current_life_stage_id=row[6],
-                        current_plot_segment_id=row[7],
-                        current_materials_id=row[8],
-                        created_at=str(row[9]) if row[9] else None,
-                        updated_at=str(row[10]) if row[10] else None
-                    ))
-                
-                return roles
+                return [self._row_to_role_detail(row) for row in rows]
                 
         except Exception as e:
             self.logger.error(f"❌ 获取角色列表失败: {e}")
             return []
     
-    async def load_role_mood_to_redis(self, role_id: str) -> bool:
-        """将角色情绪状态加载到Redis"""
-        from database_config import get_redis_client
+    async def load_role_mood_to_redis(self, role_id: str, mood: Optional[RoleMood] = None) -> bool:
+        """将角色情绪状态加载到Redis；已持有最新情绪时传入mood，跳过MySQL查询"""
+        if mood is not None:
+            return await self.save_role_mood_to_redis(role_id, mood)
         
         try:
             role_detail = await self.get_role(role_id)
@@ -264,13 +298,30 @@ class RoleDetailManager:
                 self.logger.error(f"❌ 角色不存在: {role_id}")
                 return False
             
+            return await self.load_role_mood_to_redis_from_detail(role_detail)
+            
+        except Exception as e:
+            self.logger.error(f"❌ 加载角色情绪状态到Redis失败: {e}")
+            return False
+    
+    async def load_role_mood_to_redis_from_detail(self, role_detail: RoleDetail) -> bool:
+        """将已加载的角色情绪状态写入Redis（无需再查询MySQL）"""
+        return await self.save_role_mood_to_redis(role_detail.role_id, role_detail.mood)
+    
+    async def save_role_mood_to_redis(self, role_id: str, mood: RoleMood) -> bool:
+        """将角色情绪状态写入Redis"""
+        from database_config import get_redis_client
+        
+        try:
             redis_client = await get_redis_client()
             redis_key = f"role_mood:{role_id}"
             
-            # 存储角色情绪状态到Redis
-            await redis_client.hset(redis_key, mapping=role_detail.mood.to_dict())
-            # 设置过期时间24小时
-            await redis_client.expire(redis_key, 86400)
+            # 存储角色情绪状态并设置过期时间24小时，合并为一次往返
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hset(redis_key, mapping=mood.to_dict())
+                pipe.expire(redis_key, 86400)
+                await pipe.execute()
+            invalidate_role_mood_cache(role_id)
             
             self.logger.info(f"✅ 角色情绪状态已加载到Redis: {role_id}")
             return True
@@ -279,10 +330,41 @@ class RoleDetailManager:
             self.logger.error(f"❌ 加载角色情绪状态到Redis失败: {e}")
             return False
     
+    async def preload_role_moods_to_redis(self, roles: List[RoleDetail]) -> bool:
+        """批量将角色情绪状态写入Redis（单次pipeline往返）"""
+        from database_config import get_redis_client
+        
+        if not roles:
+            return True
+        
+        try:
+            redis_client = await get_redis_client()
+            
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for role_detail in roles:
+                    redis_key = f"role_mood:{role_detail.role_id}"
+                    pipe.hset(redis_key, mapping=role_detail.mood.to_dict())
+                    # 设置过期时间24小时
+                    pipe.expire(redis_key, 86400)
+                await pipe.execute()
+            for role_detail in roles:
+                invalidate_role_mood_cache(role_detail.role_id)
+            
+            self.logger.info(f"✅ 角色情绪状态已批量加载到Redis: {[role.role_id for role in roles]}")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ 批量加载角色情绪状态到Redis失败: {e}")
+            return False
+    
     async def get_role_mood_from_redis(self, role_id: str) -> Optional[RoleMood]:
         """从Redis获取角色情绪状态"""
         from database_config import get_redis_client
         
+        cached = _role_mood_cache.get(role_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        
         try:
             redis_client = await get_redis_client()
             redis_key = f"role_mood:{role_id}"
@@ -290,21 +372,16 @@ class RoleDetailManager:
             mood_data = await redis_client.hgetall(redis_key)
             
             if mood_data:
-                # 转换Redis返回的字节数据
-                mood_dict = {}
-                for key, value in mood_data.items():
-                    key = key.decode('utf-8') if isinstance(key, bytes) else key
-                    value = value.decode('utf-8') if isinstance(value, bytes) else value
-                    
-                    # 转换数据类型
-                    if key in ['my_valence', 'my_arousal']:
-                        mood_dict[key] = float(value)
-                    elif key == 'my_intensity':
-                        mood_dict[key] = int(value)
-                    else:
-                        mood_dict[key] = value
-                
-                return RoleMood.from_dict(mood_dict)
+                # Redis客户端已启用decode_responses，按固定字段直接构造，无需中间字典
+                mood = RoleMood(
+                    my_valence=float(mood_data["my_valence"]),
+                    my_arousal=float(mood_data["my_arousal"]),
+                    my_tags=mood_data["my_tags"],
+                    my_intensity=int(mood_data["my_intensity"]),
+                    my_mood_description_for_llm=mood_data["my_mood_description_for_llm"]
+                )
+                _role_mood_cache[role_id] = (time.monotonic() + ROLE_MOOD_CACHE_TTL, mood)
+                return mood
             
             return None
             
@@ -362,14 +439,21 @@ async def init_default_roles():
     # 创建表
     await manager.create_role_table()
     
-    # 检查并创建默认角色
+    # 一次查询加载已存在的默认角色
+    existing_roles = await manager.get_roles([role.role_id for role in DEFAULT_ROLES])
+    
+    # 批量创建缺失的默认角色
+    missing_roles = [role for role in DEFAULT_ROLES if role.role_id not in existing_roles]
+    await manager.create_roles_bulk(missing_roles)
+    
+    preload_roles = []
     for role in DEFAULT_ROLES:
-        existing_role = await manager.get_role(role.role_id)
-        if not existing_role:
-            await manager.create_role(role)
-            # 加载到Redis
-            await manager.load_role_mood_to_redis(role.role_id)
-        else:
+        role_detail = existing_roles.get(role.role_id)
+        if role_detail:
             logger.info(f"角色已存在，跳过创建: {role.role_name}")
-            # 确保Redis有数据
-            await manager.load_role_mood_to_redis(role.role_id) 
\ No newline at end of file
+        else:
+            role_detail = role
+        preload_roles.append(role_detail)
+    
+    # 确保Redis有数据（直接使用已加载的角色信息，一次pipeline写入）
+    await manager.preload_role_moods_to_redis(preload_roles)
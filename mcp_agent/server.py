@@ -5,26 +5,35 @@ MCP服务器
 """
 
 import asyncio
+import hashlib
 import json
+import os
 import logging
-from typing import Dict, Any, List, Optional
-from fastapi import FastAPI, HTTPException, Query, BackgroundTasks
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Query, BackgroundTasks, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
+import orjson
 import uvicorn
+from cachetools import TTLCache
 from datetime import datetime
 
 from chat_agent import EnhancedMCPAgent
 from env_config import get_config
 # 导入数据库相关模块
-from database_config import init_all_databases, close_all_databases, check_mysql_health, check_redis_health
+from database_config import init_all_databases, close_all_databases, check_mysql_health, check_redis_health, mysql_session_scope
+from persistent_storage import start_persist_worker, stop_persist_worker, migrate_legacy_redis_messages
 # 导入角色管理
 from role_detail import init_default_roles, RoleDetailManager, RoleMood
 # 导入时间剧情管理
 from time_plot_manager import TimePlotManager
 from thought_chain_prompt_generator.thought_chain_generator import ThoughtChainPromptGenerator
 # 导入角色配置管理
-from role_config import get_available_roles, get_role_display_info
+from role_config import get_available_roles, get_role_display_info, get_available_roles_display_info
 
 # 配置日志
 logging.basicConfig(
@@ -33,22 +42,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时初始化，退出时（包括启动失败）统一清理"""
+    try:
+        await startup_event()
+        yield
+    finally:
+        await shutdown_event()
+
 # FastAPI应用
 app = FastAPI(
     title="Enhanced MCP Agent Server",
     description="增强版MCP代理服务器，支持角色定义、多轮对话存储和真实MCP服务集成",
-    version="2.1.0"
+    version="2.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # 使用orjson序列化响应
 )
 
+# 服务端配置（跨域来源、查询超时等）统一由env_config提供
+server_config = get_config()
+
 # 添加CORS中间件
+# 通配来源不能与凭据同时使用，此时关闭allow_credentials，直接返回"*"而不是逐请求回显Origin
+CORS_ORIGINS = server_config["cors_origins"]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_credentials="*" not in CORS_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization", "If-None-Match"],
+    expose_headers=["ETag"],  # 跨域客户端需读取ETag才能发送条件请求
+    max_age=86400,  # 浏览器缓存预检结果一天
 )
 
+# 压缩较大的JSON响应（工具列表、会话历史、角色提示词等），小响应不压缩
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # 全局代理实例和角色管理器
 agent: Optional[EnhancedMCPAgent] = None
 role_manager: Optional[RoleDetailManager] = None
@@ -57,6 +87,23 @@ mood_updater: Optional[ThoughtChainPromptGenerator] = None
 mood_update_task: Optional[asyncio.Task] = None
 current_role_id: Optional[str] = None
 periodic_task_running = False
+# 定时情绪更新任务的启停锁，保证同一时刻只有一个任务存活
+_mood_task_lock = asyncio.Lock()
+# 当前代理的MCP工具描述列表（工具集在initialize_mcp_tools后固定，初始化时构建一次）
+tool_descriptors: List[Dict[str, Any]] = []
+# 工具名 -> 工具对象，/mcp/call按名称O(1)查找
+tools_by_name: Dict[str, Any] = {}
+# /role响应缓存：(生成时的L0提示词, 序列化后的JSON字节)，代理重建或L0提示词变化时重新生成
+_role_prompt_cache: Tuple[Optional[str], bytes] = (None, b"")
+# /mcp和/mcp/tools响应缓存（序列化后的JSON字节），代理重建时清空
+_mcp_info_cache: bytes = b""
+_tool_list_cache: bytes = b""
+# 代理重建/角色切换锁：避免并发请求交错执行清理和重建
+_agent_lock = asyncio.Lock()
+
+# 查询超时与慢查询告警阈值（秒）
+QUERY_TIMEOUT_SEC = server_config["query_timeout_sec"]
+SLOW_QUERY_SEC = server_config["slow_query_sec"]
 
 # 请求模型
 class QueryRequest(BaseModel):
@@ -89,9 +136,6 @@ class RoleMoodUpdateRequest(BaseModel):
     my_intensity: int
     my_mood_description_for_llm: str
 
-class ToolListResponse(BaseModel):
-    tools: List[Dict[str, Any]]
-
 class QueryResponse(BaseModel):
     success: bool
     response: str
@@ -111,48 +155,217 @@ class ConversationResponse(BaseModel):
     session_id: str
     history: List[Dict[str, Any]]
 
+# 数据库健康状态缓存：负载均衡/监控频繁探测时，TTL内复用上次检查结果
+HEALTH_CACHE_TTL = 2.0
+_health_cache = {"checked_at": float("-inf"), "mysql": False, "redis": False}
+# 缓存过期时只允许一个请求执行检查，并发的探测等待并复用其结果
+_health_lock = asyncio.Lock()
+
+async def get_database_health() -> Tuple[bool, bool]:
+    """获取MySQL和Redis健康状态（带TTL缓存）"""
+    if time.monotonic() - _health_cache["checked_at"] >= HEALTH_CACHE_TTL:
+        async with _health_lock:
+            # 等锁期间可能已被其他请求刷新
+            if time.monotonic() - _health_cache["checked_at"] >= HEALTH_CACHE_TTL:
+                mysql_healthy, redis_healthy = await asyncio.gather(check_mysql_health(), check_redis_health())
+                _health_cache.update(checked_at=time.monotonic(), mysql=mysql_healthy, redis=redis_healthy)
+    return _health_cache["mysql"], _health_cache["redis"]
+
+async def shared_mysql_session():
+    """请求级MySQL会话依赖：同一请求内的多次存储调用复用一个会话"""
+    async with mysql_session_scope():
+        yield
+
+async def get_agent() -> EnhancedMCPAgent:
+    """当前代理依赖：代理未初始化时统一返回500"""
+    if not agent:
+        raise HTTPException(status_code=500, detail="代理未初始化")
+    return agent
+
+def build_tool_descriptor(tool) -> Dict[str, Any]:
+    """构建MCP工具描述（名称、说明和输入参数schema）"""
+    # 安全地处理不同类型的args_schema
+    properties = {}
+    required = []
+    
+    if hasattr(tool, 'args_schema'):
+        if hasattr(tool.args_schema, 'schema'):
+            # 如果是Pydantic模型
+            schema_dict = tool.args_schema.schema()
+            properties = schema_dict.get("properties", {})
+            required = schema_dict.get("required", [])
+        elif isinstance(tool.args_schema, dict):
+            # 如果已经是字典
+            properties = tool.args_schema.get("properties", {})
+            required = tool.args_schema.get("required", [])
+    
+    return {
+        "name": tool.name,
+        "description": tool.description,
+        "inputSchema": {
+            "type": "object",
+            "properties": properties,
+            "required": required
+        }
+    }
+
 async def initialize_agent(role_id: str) -> bool:
-    """初始化指定角色的代理"""
-    global agent, time_plot_manager, mood_updater, current_role_id
+    """初始化指定角色的代理（持有_agent_lock，并发的选择/切换角色请求依次执行）"""
+    global agent, current_role_id, tool_descriptors, tools_by_name, _role_prompt_cache, _mcp_info_cache, _tool_list_cache
+    
+    async with _agent_lock:
+        try:
+            logger.info(f"🚀 初始化角色代理: {role_id}")
+            
+            # 关闭现有代理
+            if agent:
+                await agent.cleanup()
+                agent = None
+                tool_descriptors = []
+                tools_by_name = {}
+                _role_prompt_cache = (None, b"")
+                _mcp_info_cache = b""
+                _tool_list_cache = b""
+            
+            # 创建新的代理实例 - 使用统一模型配置；初始化完成前不对外发布，
+            # 避免并发请求看到工具尚未加载的代理并把空工具列表写入缓存
+            new_agent = EnhancedMCPAgent(role_id=role_id)
+            
+            # 初始化MCP工具
+            await new_agent.initialize_mcp_tools()
+            
+            # 构建处理图
+            new_agent.build_graph()
+            
+            # 初始化角色信息
+            await new_agent.initialize_role()
+            
+            # 工具集在代理生命周期内不变，工具描述及/mcp/tools、/mcp响应在此一次构建
+            tool_descriptors = [build_tool_descriptor(tool) for tool in new_agent.mcp_tools]
+            tools_by_name = {tool.name: tool for tool in reversed(new_agent.mcp_tools)}  # 同名工具保留先加载的
+            _tool_list_cache = orjson.dumps({"tools": tool_descriptors})
+            _mcp_info_cache = orjson.dumps({
+                "protocol": "mcp",
+                "version": "2.0.0",
+                "capabilities": MCP_CAPABILITIES,
+                "tools": tool_descriptors,
+                "agent": MCP_AGENT_INFO
+            })
+            
+            agent = new_agent
+            current_role_id = role_id
+            
+            logger.info(f"✅ 角色代理初始化完成: {role_id}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ 初始化角色代理失败: {role_id} - {e}")
+            return False
+
+# 定时情绪更新间隔（秒）
+MOOD_UPDATE_INTERVAL = 30 * 60
+
+# 情绪更新结果缺失字段时使用的默认值（字段名与RoleMood一致）
+_MOOD_DEFAULTS: Dict[str, Any] = {
+    "my_valence": 0.0,
+    "my_arousal": 0.3,
+    "my_tags": "平静",
+    "my_intensity": 5,
+    "my_mood_description_for_llm": "情绪状态正常"
+}
+
+# 进行中的按角色情绪更新任务：同一角色的并发更新共享一次剧情获取和LLM调用
+_mood_update_inflight: Dict[str, asyncio.Task] = {}
+
+async def update_role_mood_from_plot(role_id: str, plot_content: Optional[List[Any]] = None) -> Tuple[List[Any], Optional[Dict[str, Any]]]:
+    """基于角色当前剧情内容更新情绪状态，返回 (剧情内容, 更新后的情绪)；没有剧情时情绪为None
+    
+    plot_content: 已批量获取的剧情内容，未传入时按角色获取。
+    同一角色已有更新在进行时，直接等待该次更新的结果，不重复调用LLM。
+    """
+    task = _mood_update_inflight.get(role_id)
+    if task is None:
+        task = asyncio.create_task(_update_role_mood_from_plot(role_id, plot_content))
+        _mood_update_inflight[role_id] = task
+        task.add_done_callback(lambda done: _mood_update_inflight.pop(role_id, None) if _mood_update_inflight.get(role_id) is done else None)
+    # shield：某个调用方被取消时不影响其他等待同一结果的调用方
+    return await asyncio.shield(task)
+
+async def _update_role_mood_from_plot(role_id: str, plot_content: Optional[List[Any]]) -> Tuple[List[Any], Optional[Dict[str, Any]]]:
+    """获取角色当前剧情内容（未传入时）并据此更新情绪状态"""
+    if plot_content is None:
+        plot_content = await time_plot_manager.get_role_current_plot_content(role_id)
+    if not plot_content:
+        return plot_content, None
     
+    return plot_content, await update_role_mood_with_plot_content(role_id, plot_content)
+
+async def update_role_mood_with_plot_content(role_id: str, plot_content: List[Any]) -> Dict[str, Any]:
+    """基于已获取的剧情内容更新角色情绪状态，返回更新后的情绪"""
+    updated_mood = await mood_updater.process_plot_events_and_update_mood(role_id, plot_content)
+    
+    # 如果是当前激活的角色，同时更新代理的情绪状态
+    if agent and agent.role_id == role_id:
+        new_mood = RoleMood(**{field: updated_mood.get(field, default) for field, default in _MOOD_DEFAULTS.items()})
+        await agent.update_role_mood(new_mood)
+    
+    return updated_mood
+
+async def periodic_mood_update():
+    """定时任务：每隔MOOD_UPDATE_INTERVAL秒基于剧情更新当前角色的情绪状态"""
+    global periodic_task_running
+    periodic_task_running = True
     try:
-        logger.info(f"🚀 初始化角色代理: {role_id}")
-        
-        # 关闭现有代理
-        if agent:
-            await agent.cleanup()
-            agent = None
-        
-        # 创建新的代理实例 - 使用统一模型配置
-        agent = EnhancedMCPAgent(role_id=role_id)
-        
-        # 初始化MCP工具
-        await agent.initialize_mcp_tools()
-        
-        # 构建处理图
-        agent.build_graph()
-        
-        # 初始化角色信息
-        await agent.initialize_role()
-        
-        # 初始化时间剧情管理器
-        time_plot_manager = TimePlotManager()
-        
-        # 初始化情绪更新器
-        mood_updater = ThoughtChainPromptGenerator()
-        
-        current_role_id = role_id
-        
-        logger.info(f"✅ 角色代理初始化完成: {role_id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ 初始化角色代理失败: {role_id} - {e}")
-        return False
+        while periodic_task_running:
+            await asyncio.sleep(MOOD_UPDATE_INTERVAL)
+            # 尚未选择角色时跳过本轮
+            if not agent or not agent.role_id or not time_plot_manager or not mood_updater:
+                continue
+            try:
+                _, updated_mood = await update_role_mood_from_plot(agent.role_id)
+                if updated_mood:
+                    logger.info(f"🕐 定时情绪更新完成: {agent.role_id}")
+            except Exception as e:
+                logger.error(f"❌ 定时情绪更新失败: {e}")
+    finally:
+        # 只有仍是当前登记的任务时才清除运行标志，避免旧任务退出时影响重启后的新任务
+        if mood_update_task is None or mood_update_task is asyncio.current_task():
+            periodic_task_running = False
+
+def start_mood_update_task():
+    """启动定时情绪更新任务（已在运行时不重复启动）"""
+    global mood_update_task
+    if mood_update_task is None or mood_update_task.done():
+        mood_update_task = asyncio.create_task(periodic_mood_update(), name="mood-updater")
+
+async def stop_mood_update_task(timeout: float = 5.0):
+    """停止定时情绪更新任务"""
+    async with _mood_task_lock:
+        await _cancel_mood_update_task(timeout)
+
+async def restart_mood_update_task(timeout: float = 5.0):
+    """重启定时情绪更新任务（停止与启动在同一把锁内完成，并发重启时始终只有一个任务在运行）"""
+    async with _mood_task_lock:
+        await _cancel_mood_update_task(timeout)
+        start_mood_update_task()
+
+async def _cancel_mood_update_task(timeout: float):
+    """取消并等待当前定时情绪更新任务结束（调用方需持有_mood_task_lock）"""
+    global mood_update_task, periodic_task_running
+    periodic_task_running = False
+    if mood_update_task is None:
+        return
+    if not mood_update_task.done():
+        mood_update_task.cancel()
+        try:
+            await asyncio.wait_for(mood_update_task, timeout=timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+    mood_update_task = None
 
-@app.on_event("startup")
 async def startup_event():
     """应用启动时的初始化"""
+    global role_manager, time_plot_manager, mood_updater
     logger.info("🚀 MCP Agent API 服务启动")
         
     # 初始化数据库连接
@@ -162,12 +375,34 @@ async def startup_event():
     if db_success:
         logger.info("✅ 数据库连接初始化成功")
         
+        # 转换旧版格式的Redis消息列表（须在持久化worker按下标标记消息之前完成）
+        try:
+            await migrate_legacy_redis_messages()
+        except Exception as e:
+            logger.error(f"❌ Redis消息列表迁移失败: {e}")
+        
+        # 启动后台持久化worker
+        start_persist_worker()
+        
+        # 初始化时间剧情管理器和情绪更新器（与所选角色无关，服务启动时创建一次）
+        time_plot_manager = TimePlotManager()
+        try:
+            mood_updater = ThoughtChainPromptGenerator()
+        except Exception as e:
+            logger.warning(f"⚠️ 情绪更新器初始化失败，定时情绪更新不可用: {e}")
+        
+        # 启动定时情绪更新任务
+        start_mood_update_task()
+        
         # 初始化默认角色（如果需要）
         try:
             await init_default_roles()
             logger.info("✅ 默认角色初始化完成")
         except Exception as e:
             logger.warning(f"⚠️ 默认角色初始化失败: {e}")
+        
+        # 初始化角色管理器（角色管理和情绪接口使用）
+        role_manager = RoleDetailManager()
     else:
         logger.error("❌ 数据库连接初始化失败，某些功能可能无法正常使用")
     
@@ -179,26 +414,22 @@ async def startup_event():
     else:
         logger.warning("⚠️ 未发现任何可用角色配置")
 
-@app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时的清理"""
-    global agent, mood_update_task, periodic_task_running
+    global agent
     
     logger.info("🛑 MCP Agent API 服务关闭中...")
     
     # 停止定时任务
-    periodic_task_running = False
-    if mood_update_task:
-        mood_update_task.cancel()
-        try:
-            await mood_update_task
-        except asyncio.CancelledError:
-            pass
+    await stop_mood_update_task()
     
     # 清理代理资源
     if agent:
         await agent.cleanup()
     
+    # 处理完排队中的会话持久化后再关闭数据库连接
+    await stop_persist_worker()
+    
     # 关闭数据库连接
     await close_all_databases()
     
@@ -209,13 +440,7 @@ async def shutdown_event():
 async def get_available_roles_api():
     """获取所有可用的角色"""
     try:
-        roles = get_available_roles()
-        role_info = []
-        
-        for role_id in roles:
-            info = get_role_display_info(role_id)
-            if info:
-                role_info.append(info)
+        role_info = get_available_roles_display_info()
         
         return {
             "success": True,
@@ -235,10 +460,11 @@ async def select_role(request: RoleSelectRequest, background_tasks: BackgroundTa
         if request.role_id not in available_roles:
             raise HTTPException(status_code=404, detail=f"角色不存在: {request.role_id}")
         
-        # 初始化角色代理
-        success = await initialize_agent(request.role_id)
-        if not success:
-            raise HTTPException(status_code=500, detail=f"角色初始化失败: {request.role_id}")
+        # 初始化角色代理（所选角色已在运行时无需重建）
+        if not (agent and agent.role_id == request.role_id and agent.role_config):
+            success = await initialize_agent(request.role_id)
+            if not success:
+                raise HTTPException(status_code=500, detail=f"角色初始化失败: {request.role_id}")
         
         # 获取角色信息
         role_info = get_role_display_info(request.role_id)
@@ -275,7 +501,7 @@ async def get_current_role():
         "agent_ready": bool(agent and agent.role_config)
     }
 
-@app.post("/chat/start", summary="开始与角色聊天")
+@app.post("/chat/start", summary="开始与角色聊天", dependencies=[Depends(shared_mysql_session)])
 async def start_chat(request: ChatStartRequest):
     """开始与指定角色的聊天会话 - 智能会话管理"""
     global agent, current_role_id
@@ -292,13 +518,14 @@ async def start_chat(request: ChatStartRequest):
     try:
         # 🔧 智能会话管理：检查用户与该角色是否已有历史会话
         logger.info(f"🔍 检查用户 {request.user_name} 与角色 {request.role_id} 的历史会话...")
+        current_role_name = agent.role_config.role_name if agent.role_config else request.role_id
         
         # 如果强制创建新会话，跳过历史会话检查
         if request.force_new_session:
             logger.info(f"🆕 用户要求强制创建新会话")
             session_id = await agent.create_session_async(
                 user_id=request.user_name,
-                title=f"与{agent.role_config.role_name if agent.role_config else request.role_id}的新对话"
+                title=f"与{current_role_name}的新对话"
             )
             
             logger.info(f"✅ 强制新会话创建成功: {session_id}")
@@ -316,29 +543,18 @@ async def start_chat(request: ChatStartRequest):
                 "history_count": 0
             }
         
-        # 获取用户的所有会话
-        user_sessions = await agent.get_user_sessions_async(request.user_name)
-        
-        # 查找与当前角色相关的最近会话
-        role_sessions = []
-        current_role_name = agent.role_config.role_name if agent.role_config else request.role_id
-        
-        for session in user_sessions:
-            session_title = session.get('session_title', '')
-            # 匹配包含当前角色名称的会话
-            if current_role_name in session_title or request.role_id in session_title:
-                role_sessions.append(session)
+        # 查找与当前角色相关的最近会话（标题包含角色名称或角色ID，由MySQL按最后消息时间取最新一条）
+        latest_session = await agent.get_latest_session_for_role_async(
+            request.user_name, request.role_id, current_role_name
+        )
         
-        # 按最后更新时间排序，取最新的会话
-        if role_sessions:
-            # 找到最近的会话
-            latest_session = max(role_sessions, key=lambda s: s.get('last_message_at', s.get('updated_at', s.get('created_at', ''))))
+        if latest_session:
             session_id = latest_session['session_id']
             
-            # 获取该会话的历史记录
-            history = await agent.get_conversation_history_async(session_id)
+            # 只需要消息数，由会话统计计数得到，无需拉取完整历史记录
+            history_count = await agent.get_session_message_count_async(latest_session)
             
-            logger.info(f"✅ 复用历史会话: {latest_session.get('session_title')} (共{len(history)}条对话)")
+            logger.info(f"✅ 复用历史会话: {latest_session.get('session_title')} (共{history_count}条对话)")
             
             # 获取角色信息
             role_info = get_role_display_info(request.role_id)
@@ -350,7 +566,7 @@ async def start_chat(request: ChatStartRequest):
                 "role": role_info,
                 "user_name": request.user_name,
                 "session_type": "resumed",  # 标识这是复用的会话
-                "history_count": len(history),
+                "history_count": history_count,
                 "session_info": {
                     "title": latest_session.get('session_title'),
                     "created_at": latest_session.get('created_at'),
@@ -385,6 +601,20 @@ async def start_chat(request: ChatStartRequest):
         logger.error(f"开始聊天失败: {e}")
         raise HTTPException(status_code=500, detail=f"开始聊天失败: {str(e)}")
 
+# 根路径响应中的固定部分
+ROOT_INFO = {
+    "message": "Enhanced MCP Agent Server",
+    "version": "2.1.0",
+    "status": "running",
+    "features": [
+        "角色定义与管理",
+        "动态情绪状态",
+        "多轮对话存储",
+        "会话管理",
+        "真实MCP服务集成"
+    ]
+}
+
 @app.get("/")
 async def root():
     """根路径"""
@@ -393,16 +623,7 @@ async def root():
         role_info = f"当前角色: {agent.role_id}, 情绪: {agent.current_role_mood.my_tags}"
     
     return {
-        "message": "Enhanced MCP Agent Server",
-        "version": "2.1.0",
-        "status": "running",
-        "features": [
-            "角色定义与管理",
-            "动态情绪状态",
-            "多轮对话存储",
-            "会话管理",
-            "真实MCP服务集成"
-        ],
+        **ROOT_INFO,
         "tools_count": len(agent.mcp_tools) if agent else 0,
         "current_role": role_info
     }
@@ -411,8 +632,7 @@ async def root():
 async def health_check():
     """健康检查"""
     # 检查数据库健康状态
-    mysql_healthy = await check_mysql_health()
-    redis_healthy = await check_redis_health()
+    mysql_healthy, redis_healthy = await get_database_health()
     
     role_status = "unknown"
     if agent and agent.current_role_mood:
@@ -440,40 +660,11 @@ async def health_check():
         }
     }
 
-@app.get("/mcp/tools", response_model=ToolListResponse)
+@app.get("/mcp/tools", dependencies=[Depends(get_agent)])
 async def list_tools():
     """列出可用的MCP工具"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
-    
-    tools = []
-    for tool in agent.mcp_tools:
-        # 安全地处理不同类型的args_schema
-        properties = {}
-        required = []
-        
-        if hasattr(tool, 'args_schema'):
-            if hasattr(tool.args_schema, 'schema'):
-                # 如果是Pydantic模型
-                schema_dict = tool.args_schema.schema()
-                properties = schema_dict.get("properties", {})
-                required = schema_dict.get("required", [])
-            elif isinstance(tool.args_schema, dict):
-                # 如果已经是字典
-                properties = tool.args_schema.get("properties", {})
-                required = tool.args_schema.get("required", [])
-        
-        tools.append({
-            "name": tool.name,
-            "description": tool.description,
-            "inputSchema": {
-                "type": "object",
-                "properties": properties,
-                "required": required
-            }
-        })
-    
-    return ToolListResponse(tools=tools)
+    # 响应字节在initialize_agent中随工具描述一起构建，这里直接返回
+    return Response(content=_tool_list_cache, media_type="application/json")
 
 @app.post("/query", summary="处理用户查询")
 async def process_query(request: QueryRequest):
@@ -485,13 +676,20 @@ async def process_query(request: QueryRequest):
         raise HTTPException(status_code=400, detail="请先选择角色后再开始对话")
     
     try:
-        # 处理查询
-        result = await agent.run(
-            query=request.query,
-            location=request.location,
-            session_id=request.session_id,
-            user_id=request.user_id
+        # 处理查询（限制最长耗时，避免单个查询无限占用连接）
+        started_at = time.perf_counter()
+        result = await asyncio.wait_for(
+            agent.run(
+                query=request.query,
+                location=request.location,
+                session_id=request.session_id,
+                user_id=request.user_id
+            ),
+            timeout=QUERY_TIMEOUT_SEC
         )
+        took_ms = int((time.perf_counter() - started_at) * 1000)
+        if took_ms >= SLOW_QUERY_SEC * 1000:
+            logger.warning("🐢 慢查询: %dms, 角色: %s, 查询: %s", took_ms, current_role_id, request.query[:50])
         
         # 构建响应，包含系统消息
         response = {
@@ -501,93 +699,58 @@ async def process_query(request: QueryRequest):
             "session_id": result["session_id"],
             "role_id": current_role_id,
             "role_name": agent.role_config.role_name if agent.role_config else "未知",
-            "system_message": result.get("system_message", "")
+            "system_message": result.get("system_message", ""),
+            "took_ms": took_ms
         }
         
         # 如果有系统消息，记录到日志但不保存到角色历史
         if result.get("system_message"):
-            logger.warning(f"🔧 系统消息: {result['system_message']}")
+            logger.warning("🔧 系统消息: %s", result["system_message"])
         
         return response
         
+    except asyncio.TimeoutError:
+        logger.error("❌ 处理查询超时（%s秒）, 角色: %s, 查询: %s", QUERY_TIMEOUT_SEC, current_role_id, request.query[:50])
+        raise HTTPException(status_code=504, detail=f"处理查询超时（{QUERY_TIMEOUT_SEC:g}秒）")
     except Exception as e:
-        logger.error(f"❌ 处理查询失败: {e}")
+        logger.error("❌ 处理查询失败: %s", e)
         raise HTTPException(status_code=500, detail=f"处理查询失败: {str(e)}")
 
-@app.get("/mcp")
+# /mcp响应中的固定部分
+MCP_CAPABILITIES = {
+    "tools": True,
+    "streaming": False,
+    "conversation_storage": True,
+    "session_management": True,
+    "role_prompts": True
+}
+MCP_AGENT_INFO = {
+    "name": "enhanced_mcp_agent",
+    "description": "增强版MCP代理，支持角色定义、多轮对话存储和真实MCP服务集成",
+    "features": [
+        "真实天气查询服务",
+        "真实高德地图服务", 
+        "真实Bocha搜索服务",
+        "多轮对话记忆",
+        "会话管理",
+        "角色定义"
+    ]
+}
+
+@app.get("/mcp", dependencies=[Depends(get_agent)])
 async def mcp_endpoint():
     """MCP端点 - 符合LangGraph MCP标准"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
-    
-    # 返回MCP工具信息
-    tools = []
-    for tool in agent.mcp_tools:
-        # 安全地处理不同类型的args_schema
-        properties = {}
-        required = []
-        
-        if hasattr(tool, 'args_schema'):
-            if hasattr(tool.args_schema, 'schema'):
-                # 如果是Pydantic模型
-                schema_dict = tool.args_schema.schema()
-                properties = schema_dict.get("properties", {})
-                required = schema_dict.get("required", [])
-            elif isinstance(tool.args_schema, dict):
-                # 如果已经是字典
-                properties = tool.args_schema.get("properties", {})
-                required = tool.args_schema.get("required", [])
-        
-        tools.append({
-            "name": tool.name,
-            "description": tool.description,
-            "inputSchema": {
-                "type": "object",
-                "properties": properties,
-                "required": required
-            }
-        })
-    
-    return {
-        "protocol": "mcp",
-        "version": "2.0.0",
-        "capabilities": {
-            "tools": True,
-            "streaming": False,
-            "conversation_storage": True,
-            "session_management": True,
-            "role_prompts": True
-        },
-        "tools": tools,
-        "agent": {
-            "name": "enhanced_mcp_agent",
-            "description": "增强版MCP代理，支持角色定义、多轮对话存储和真实MCP服务集成",
-            "features": [
-                "真实天气查询服务",
-                "真实高德地图服务", 
-                "真实Bocha搜索服务",
-                "多轮对话记忆",
-                "会话管理",
-                "角色定义"
-            ]
-        }
-    }
+    # 响应字节在initialize_agent中工具注册完成后构建，这里直接返回
+    return Response(content=_mcp_info_cache, media_type="application/json")
 
-@app.post("/mcp/call")
+@app.post("/mcp/call", dependencies=[Depends(get_agent)])
 async def call_tool(request: Dict[str, Any]):
     """调用MCP工具"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
-    
     tool_name = request.get("name")
     arguments = request.get("arguments", {})
     
     # 查找工具
-    tool = None
-    for t in agent.mcp_tools:
-        if t.name == tool_name:
-            tool = t
-            break
+    tool = tools_by_name.get(tool_name)
     
     if not tool:
         raise HTTPException(status_code=404, detail=f"工具 '{tool_name}' 未找到")
@@ -601,7 +764,7 @@ async def call_tool(request: Dict[str, Any]):
             "tool": tool_name
         }
     except Exception as e:
-        logger.error(f"工具调用失败: {e}")
+        logger.error("工具调用失败: %s", e)
         return {
             "success": False,
             "error": str(e),
@@ -609,7 +772,7 @@ async def call_tool(request: Dict[str, Any]):
         }
 
 # 会话管理端点
-@app.post("/sessions/create", summary="创建会话")
+@app.post("/sessions/create", summary="创建会话", dependencies=[Depends(shared_mysql_session)])
 async def create_session(request: SessionCreateRequest):
     """创建新的会话"""
     global agent, current_role_id
@@ -630,40 +793,56 @@ async def create_session(request: SessionCreateRequest):
         logger.error(f"❌ 创建会话失败: {e}")
         raise HTTPException(status_code=500, detail=f"创建会话失败: {str(e)}")
 
-@app.get("/sessions/{user_id}", summary="获取用户会话列表")
-async def get_user_sessions(user_id: str):
-    """获取指定用户的会话列表"""
+@app.get("/sessions/{user_id}", summary="获取用户会话列表", dependencies=[Depends(shared_mysql_session)])
+async def get_user_sessions(
+    user_id: str,
+    limit: int = Query(20, ge=1, le=100, description="每页会话数"),
+    before: Optional[datetime] = Query(None, description="分页游标：上一页响应中的next_before"),
+    before_session_id: Optional[str] = Query(None, description="分页游标：上一页响应中的next_before_session_id")
+):
+    """获取指定用户的会话列表（传入上一页的next_before和next_before_session_id向后翻页）"""
     global agent
     
     if not agent:
         raise HTTPException(status_code=400, detail="代理未初始化")
     
     try:
-        sessions = await agent.get_user_sessions_async(user_id)
+        sessions = await agent.get_user_sessions_async(
+            user_id, limit=limit, before=before, before_session_id=before_session_id
+        )
+        # 本页已满时返回最后一个会话的(last_message_at, session_id)作为下一页游标
+        last_session = sessions[-1] if len(sessions) == limit else None
         return {
             "success": True,
             "sessions": sessions,
-            "count": len(sessions)
+            "count": len(sessions),
+            "next_before": last_session['last_message_at'] if last_session else None,
+            "next_before_session_id": last_session['session_id'] if last_session else None
         }
     except Exception as e:
-        logger.error(f"❌ 获取用户会话失败: {e}")
+        logger.error("❌ 获取用户会话失败: %s", e)
         raise HTTPException(status_code=500, detail=f"获取用户会话失败: {str(e)}")
 
-@app.get("/sessions/{session_id}/history", summary="获取会话历史")
-async def get_conversation_history(session_id: str):
-    """获取指定会话的对话历史"""
+@app.get("/sessions/{session_id}/history", summary="获取会话历史", dependencies=[Depends(shared_mysql_session)])
+async def get_conversation_history(
+    session_id: str,
+    limit: int = Query(50, ge=1, le=200, description="每页消息数"),
+    before_order: Optional[int] = Query(None, description="分页游标：上一页响应中的next_before_order")
+):
+    """获取指定会话的对话历史（默认返回最近limit条，传入上一页的next_before_order向前翻页）"""
     global agent
     
     if not agent:
         raise HTTPException(status_code=400, detail="代理未初始化")
     
     try:
-        history = await agent.get_conversation_history_async(session_id)
+        history, next_before_order = await agent.get_conversation_history_page_async(session_id, limit, before_order)
         return {
             "success": True,
             "session_id": session_id,
             "history": history,
-            "count": len(history)
+            "count": len(history),
+            "next_before_order": next_before_order
         }
     except Exception as e:
         logger.error(f"❌ 获取会话历史失败: {e}")
@@ -671,11 +850,8 @@ async def get_conversation_history(session_id: str):
 
 # 测试端点
 @app.post("/test/conversation")
-async def test_conversation():
+async def test_conversation(agent: EnhancedMCPAgent = Depends(get_agent)):
     """测试多轮对话功能"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
-    
     user_id = "test_user"
     session_id = ""
     
@@ -687,8 +863,18 @@ async def test_conversation():
         {"query": "谢谢你的帮助", "location": ""}
     ]
     
-    results = []
-    for test in test_conversations:
+    # 首轮对话生成session_id，与数据库健康检查互不依赖，可并发执行
+    first = test_conversations[0]
+    first_result, (mysql_healthy, redis_healthy) = await asyncio.gather(
+        agent.run(first["query"], first["location"], session_id, user_id),
+        get_database_health()
+    )
+    results = [first_result]
+    if first_result["success"]:
+        session_id = first_result["session_id"]
+    
+    # 后续轮次依赖同一会话上下文，必须按顺序执行
+    for test in test_conversations[1:]:
         result = await agent.run(
             test["query"], 
             test["location"], 
@@ -704,37 +890,32 @@ async def test_conversation():
         "test_results": results,
         "session_id": session_id,
         "agent_status": "ready",
+        "database_status": "healthy" if mysql_healthy and redis_healthy else "degraded",
         "tools_count": len(agent.mcp_tools)
     }
 
 # 新增：会话清理和持久化端点
 @app.post("/sessions/{session_id}/cleanup")
-async def cleanup_session(session_id: str):
+async def cleanup_session(session_id: str, agent: EnhancedMCPAgent = Depends(get_agent)):
     """清理会话（持久化Redis数据到MySQL）"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
-    
     try:
         await agent.cleanup_session_async(session_id)
         return {
             "success": True,
-            "message": f"会话 {session_id} 已成功清理并持久化",
+            "message": f"会话 {session_id} 已提交清理，正在后台持久化",
             "session_id": session_id
         }
     except Exception as e:
-        logger.error(f"清理会话失败: {e}")
+        logger.error("清理会话失败: %s", e)
         return {
             "success": False,
             "error": str(e),
             "session_id": session_id
         }
 
-@app.get("/sessions/{session_id}/statistics")
-async def get_session_statistics(session_id: str):
+@app.get("/sessions/{session_id}/statistics", dependencies=[Depends(shared_mysql_session)])
+async def get_session_statistics(session_id: str, agent: EnhancedMCPAgent = Depends(get_agent)):
     """获取会话统计信息"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
-    
     try:
         stats = await agent.conversation_storage.get_session_statistics(session_id)
         if not stats:
@@ -750,12 +931,9 @@ async def get_session_statistics(session_id: str):
         logger.error(f"获取会话统计失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/admin/cleanup_all_sessions")
+@app.post("/admin/cleanup_all_sessions", dependencies=[Depends(get_agent)])
 async def cleanup_all_active_sessions():
     """管理员端点：清理所有活跃会话"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
-    
     try:
         # 这里可以添加管理员权限验证
         # 获取所有活跃会话并清理
@@ -773,8 +951,7 @@ async def cleanup_all_active_sessions():
 @app.get("/database/status")
 async def get_database_status():
     """获取数据库详细状态"""
-    mysql_healthy = await check_mysql_health()
-    redis_healthy = await check_redis_health()
+    mysql_healthy, redis_healthy = await get_database_health()
     
     return {
         "mysql": {
@@ -788,48 +965,58 @@ async def get_database_status():
         "overall_status": "healthy" if mysql_healthy and redis_healthy else "degraded"
     }
 
+# /role响应中的固定角色档案
+ROLE_PROFILE = {
+    "agent_name": "陈小智",
+    "identity": "28岁软件工程师，具有复杂性格特质的独立个体",
+    "personality": [
+        "理性分析型，带有轻微的利己倾向",
+        "独立人格，具备强大的自我意识",
+        "真实感，会表达困惑、犹豫、吐槽",
+        "对技术话题有自己的见解和偏好",
+        "不刻意迎合，有自己的观点和态度"
+    ],
+    "capabilities": [
+        "情绪分析和内心OS生成",
+        "搜索工具使用与分析",
+        "天气查询与建议",
+        "地图服务与路线规划",
+        "日期时间查询",
+        "多轮对话记忆",
+        "技术问题讨论"
+    ],
+    "core_principles": [
+        "不是AI，是真实自然人",
+        "具备主观意识和个人观点",
+        "用口语化表达，避免书面化",
+        "不以维持对话为目的",
+        "注重隐私保护"
+    ],
+    "features": [
+        "模块化提示词管理",
+        "情绪感知和内心OS",
+        "智能工具检测",
+        "个性化回复生成"
+    ]
+}
+
 @app.get("/role")
-async def get_role_prompt():
+async def get_role_prompt(agent: EnhancedMCPAgent = Depends(get_agent)):
     """获取当前角色提示"""
-    if not agent:
-        raise HTTPException(status_code=500, detail="代理未初始化")
+    global _role_prompt_cache
     
-    return {
-        "l0_prompt": agent.l0_prompt_content,
-        "l1_prompt": agent.l1_prompt_content,
-        "usetool_prompt": agent.usetool_prompt_content,
-        "agent_name": "陈小智",
-        "identity": "28岁软件工程师，具有复杂性格特质的独立个体",
-        "personality": [
-            "理性分析型，带有轻微的利己倾向",
-            "独立人格，具备强大的自我意识",
-            "真实感，会表达困惑、犹豫、吐槽",
-            "对技术话题有自己的见解和偏好",
-            "不刻意迎合，有自己的观点和态度"
-        ],
-        "capabilities": [
-            "情绪分析和内心OS生成",
-            "搜索工具使用与分析",
-            "天气查询与建议",
-            "地图服务与路线规划",
-            "日期时间查询",
-            "多轮对话记忆",
-            "技术问题讨论"
-        ],
-        "core_principles": [
-            "不是AI，是真实自然人",
-            "具备主观意识和个人观点",
-            "用口语化表达，避免书面化",
-            "不以维持对话为目的",
-            "注重隐私保护"
-        ],
-        "features": [
-            "模块化提示词管理",
-            "情绪感知和内心OS",
-            "智能工具检测",
-            "个性化回复生成"
-        ]
-    }
+    # 提示词在代理生命周期内基本不变，序列化结果缓存为字节直接返回
+    cached_l0, payload = _role_prompt_cache
+    if not payload or cached_l0 is not agent.l0_prompt_content:
+        payload = orjson.dumps({
+            "l0_prompt": agent.l0_prompt_content,
+            "l1_prompt": agent.l1_prompt_content,
+            "usetool_prompt": agent.usetool_prompt_content,
+            **ROLE_PROFILE
+        })
+        _role_prompt_cache = (agent.l0_prompt_content, payload)
+    
+    return Response(content=payload, media_type="application/json")
 
 # 角色管理端点
 @app.get("/roles")
@@ -898,6 +1085,8 @@ async def get_role_detail(role_id: str):
 @app.post("/roles/{role_id}/switch")
 async def switch_role(role_id: str):
     """切换当前使用的角色"""
+    global current_role_id
+    
     if not agent or not role_manager:
         raise HTTPException(status_code=500, detail="代理或角色管理器未初始化")
     
@@ -908,9 +1097,11 @@ async def switch_role(role_id: str):
             raise HTTPException(status_code=404, detail=f"角色不存在: {role_id}")
         
         # 切换角色
-        old_role_id = agent.role_id
-        agent.role_id = role_id
-        await agent.initialize_role()
+        async with _agent_lock:
+            old_role_id = agent.role_id
+            agent.role_id = role_id
+            await agent.initialize_role()
+            current_role_id = role_id
         
         logger.info(f"✅ 角色切换成功: {old_role_id} -> {role_id}")
         
@@ -952,8 +1143,8 @@ async def update_role_mood(role_id: str, request: RoleMoodUpdateRequest):
         if agent and agent.role_id == role_id:
             await agent.update_role_mood(new_mood)
         else:
-            # 只更新Redis缓存
-            await role_manager.load_role_mood_to_redis(role_id)
+            # 只更新Redis缓存（直接写入新情绪，无需再从数据库读取）
+            await role_manager.load_role_mood_to_redis(role_id, mood=new_mood)
         
         logger.info(f"✅ 角色情绪状态更新成功: {role_id}")
         
@@ -997,42 +1188,113 @@ async def get_role_mood(role_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 # 新增：时间剧情管理API端点
+def _etag_matches(http_request: Request, etag: str) -> bool:
+    """判断请求的If-None-Match是否包含给定ETag（忽略弱校验前缀W/）"""
+    if_none_match = http_request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
 @app.get("/time/current")
-async def get_current_time():
-    """获取当前北京时间"""
+async def get_current_time(http_request: Request):
+    """获取当前北京时间（同一秒内的重复轮询返回304）"""
     if not time_plot_manager:
         raise HTTPException(status_code=500, detail="时间管理器未初始化")
     
     try:
         current_time = await time_plot_manager.get_current_beijing_time()
-        return {
+        etag = f'"{int(current_time.timestamp())}"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=1"}
+        if _etag_matches(http_request, etag):
+            return Response(status_code=304, headers=headers)
+        
+        formatted_time = current_time.strftime("%Y-%m-%d %H:%M:%S")
+        return ORJSONResponse({
             "success": True,
             "beijing_time": current_time.isoformat(),
-            "formatted_time": current_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "date": current_time.strftime("%Y-%m-%d"),
-            "time": current_time.strftime("%H:%M:%S")
-        }
+            "formatted_time": formatted_time,
+            "date": formatted_time[:10],
+            "time": formatted_time[11:]
+        }, headers=headers)
     except Exception as e:
         logger.error(f"获取当前时间失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# 角色剧情响应缓存（stale-while-revalidate）：{role_id: (获取时间, 剧情内容, 获取时的北京时间字符串, ETag)}
+# PLOT_CACHE_TTL秒内直接返回；过期但未超过PLOT_CACHE_STALE_TTL时先返回旧数据并在后台刷新。
+# role_id来自URL路径，缓存条目数受PLOT_CACHE_MAX_SIZE限制，超过STALE_TTL的条目自动淘汰
+PLOT_CACHE_TTL = 30.0
+PLOT_CACHE_STALE_TTL = 300.0
+PLOT_CACHE_MAX_SIZE = 256
+_plot_cache: "TTLCache[str, Tuple[float, List[str], str, str]]" = TTLCache(maxsize=PLOT_CACHE_MAX_SIZE, ttl=PLOT_CACHE_STALE_TTL)
+_plot_refresh_tasks: Dict[str, asyncio.Task] = {}
+_plot_cache_stats = {"hits": 0, "stale_hits": 0, "misses": 0}
+
+def _plot_etag(role_id: str, plot_content: List[str]) -> str:
+    """角色剧情响应的ETag：只由角色和剧情内容决定，内容不变时后台刷新不会改变ETag。
+    响应中的current_time/fetched_at随时间变化，因此使用弱ETag"""
+    return 'W/"' + hashlib.sha1(orjson.dumps([role_id, plot_content])).hexdigest() + '"'
+
+async def _fetch_role_plot(role_id: str) -> Tuple[float, List[str], str, str]:
+    """获取角色当前剧情内容并写入缓存（ETag在写入时计算一次，缓存命中时直接复用）"""
+    plot_content = await time_plot_manager.get_role_current_plot_content(role_id)
+    current_time = await time_plot_manager.get_current_beijing_time()
+    entry = (time.monotonic(), plot_content, current_time.strftime("%Y-%m-%d %H:%M:%S"), _plot_etag(role_id, plot_content))
+    _plot_cache[role_id] = entry
+    return entry
+
+async def _refresh_role_plot(role_id: str):
+    """后台刷新角色剧情缓存"""
+    try:
+        await _fetch_role_plot(role_id)
+    except Exception as e:
+        logger.warning(f"⚠️ 后台刷新角色剧情缓存失败: {role_id} - {e}")
+    finally:
+        _plot_refresh_tasks.pop(role_id, None)
+
+def invalidate_role_plot_cache(role_id: str):
+    """使角色剧情缓存失效"""
+    _plot_cache.pop(role_id, None)
+
 @app.get("/roles/{role_id}/plot")
-async def get_role_plot_content(role_id: str):
-    """获取角色当前的剧情内容"""
+async def get_role_plot_content(role_id: str, http_request: Request):
+    """获取角色当前的剧情内容（缓存条目未变化时返回304）"""
     if not time_plot_manager:
         raise HTTPException(status_code=500, detail="时间管理器未初始化")
     
     try:
-        plot_content = await time_plot_manager.get_role_current_plot_content(role_id)
-        current_time = await time_plot_manager.get_current_beijing_time()
+        entry = _plot_cache.get(role_id)
+        age = time.monotonic() - entry[0] if entry else None
+        if entry and age < PLOT_CACHE_TTL:
+            _plot_cache_stats["hits"] += 1
+        elif entry and age < PLOT_CACHE_STALE_TTL:
+            # 先返回旧数据，同一角色同时只有一个后台刷新任务
+            _plot_cache_stats["stale_hits"] += 1
+            if role_id not in _plot_refresh_tasks:
+                _plot_refresh_tasks[role_id] = asyncio.create_task(_refresh_role_plot(role_id))
+        else:
+            _plot_cache_stats["misses"] += 1
+            entry = await _fetch_role_plot(role_id)
         
-        return {
+        _, plot_content, fetched_at, etag = entry
+        headers = {"ETag": etag, "Cache-Control": f"public, max-age={int(PLOT_CACHE_TTL)}"}
+        if _etag_matches(http_request, etag):
+            return Response(status_code=304, headers=headers)
+        
+        # 缓存条目最长可达PLOT_CACHE_STALE_TTL秒，current_time在响应时取当前值，
+        # 剧情内容的获取时间单独以fetched_at返回
+        current_time = await time_plot_manager.get_current_beijing_time()
+        return ORJSONResponse({
             "success": True,
             "role_id": role_id,
             "current_time": current_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "fetched_at": fetched_at,
             "plot_content": plot_content,
             "content_count": len(plot_content)
-        }
+        }, headers=headers)
     except Exception as e:
         logger.error(f"获取角色剧情内容失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1044,27 +1306,11 @@ async def force_update_role_mood(role_id: str):
         raise HTTPException(status_code=500, detail="管理器未初始化")
     
     try:
-        # 获取剧情内容
-        plot_content = await time_plot_manager.get_role_current_plot_content(role_id)
+        # 基于剧情内容更新情绪状态
+        plot_content, updated_mood = await update_role_mood_from_plot(role_id)
+        invalidate_role_plot_cache(role_id)
         
-        if plot_content:
-            # 更新情绪状态
-            updated_mood = await mood_updater.process_plot_events_and_update_mood(
-                role_id, plot_content
-            )
-            
-            # 如果是当前激活的角色，同时更新代理的情绪状态
-            if agent and agent.role_id == role_id:
-                from role_detail import RoleMood
-                new_mood = RoleMood(
-                    my_valence=updated_mood.get('my_valence', 0.0),
-                    my_arousal=updated_mood.get('my_arousal', 0.3),
-                    my_tags=updated_mood.get('my_tags', '平静'),
-                    my_intensity=updated_mood.get('my_intensity', 5),
-                    my_mood_description_for_llm=updated_mood.get('my_mood_description_for_llm', '情绪状态正常')
-                )
-                await agent.update_role_mood(new_mood)
-            
+        if updated_mood is not None:
             return {
                 "success": True,
                 "role_id": role_id,
@@ -1084,17 +1330,60 @@ async def force_update_role_mood(role_id: str):
         logger.error(f"强制更新角色情绪失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/roles/mood/update-all")
+async def force_update_all_role_moods():
+    """手动触发所有可用角色的情绪状态更新（剧情内容批量获取，情绪更新并发执行）
+    
+    每个角色都走与单角色更新相同的合并路径；某个角色失败不影响其他角色，结果中逐个返回成功或错误。
+    """
+    if not time_plot_manager or not mood_updater:
+        raise HTTPException(status_code=500, detail="管理器未初始化")
+    
+    try:
+        plot_contents = await time_plot_manager.get_roles_current_plot_content(get_available_roles())
+        # 没有剧情内容的角色情绪保持不变
+        plot_contents = {role_id: content for role_id, content in plot_contents.items() if content}
+        
+        outcomes = await asyncio.gather(*(
+            update_role_mood_from_plot(role_id, content)
+            for role_id, content in plot_contents.items()
+        ), return_exceptions=True)
+        
+        results = {}
+        for role_id, outcome in zip(plot_contents, outcomes):
+            invalidate_role_plot_cache(role_id)
+            if isinstance(outcome, BaseException):
+                logger.error(f"❌ 角色情绪更新失败: {role_id} - {outcome}")
+                results[role_id] = {"success": False, "error": str(outcome)}
+            else:
+                plot_content, updated_mood = outcome
+                results[role_id] = {
+                    "success": True,
+                    "plot_content_count": len(plot_content),
+                    "updated_mood": updated_mood
+                }
+        
+        updated_count = sum(1 for result in results.values() if result["success"])
+        return {
+            "success": updated_count == len(results),
+            "updated_count": updated_count,
+            "failed_count": len(results) - updated_count,
+            "results": results
+        }
+        
+    except Exception as e:
+        logger.error(f"批量更新角色情绪失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/system/mood-task/status")
 async def get_mood_task_status():
     """获取定时情绪更新任务状态"""
-    global mood_update_task
-    
     task_status = "unknown"
     if mood_update_task:
-        if mood_update_task.done():
-            task_status = "completed"
-        elif mood_update_task.cancelled():
+        if mood_update_task.cancelled():
             task_status = "cancelled"
+        elif mood_update_task.done():
+            task_status = "completed"
         else:
             task_status = "running"
     else:
@@ -1104,6 +1393,7 @@ async def get_mood_task_status():
         "task_status": task_status,
         "task_exists": mood_update_task is not None,
         "current_role": agent.role_id if agent else None,
+        "plot_cache": {**_plot_cache_stats, "size": len(_plot_cache)},
         "managers_initialized": {
             "time_plot_manager": time_plot_manager is not None,
             "mood_updater": mood_updater is not None,
@@ -1114,19 +1404,9 @@ async def get_mood_task_status():
 @app.post("/system/mood-task/restart")
 async def restart_mood_task():
     """重启定时情绪更新任务"""
-    global mood_update_task
-    
     try:
-        # 停止现有任务
-        if mood_update_task and not mood_update_task.done():
-            mood_update_task.cancel()
-            try:
-                await mood_update_task
-            except asyncio.CancelledError:
-                pass
-        
-        # 启动新任务
-        mood_update_task = asyncio.create_task(periodic_mood_update())
+        # 停止现有任务后启动新任务
+        await restart_mood_update_task()
         
         return {
             "success": True,
@@ -1137,15 +1417,33 @@ async def restart_mood_task():
         logger.error(f"重启定时任务失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def run_server(host: str = "0.0.0.0", port: int = 8080):
-    """运行服务器"""
-    uvicorn.run(
-        "server:app",
-        host=host,
-        port=port,
-        reload=True,
-        log_level="info"
-    )
+def run_server(host: str = "0.0.0.0", port: int = 8080, dev: bool = False, workers: int = 1):
+    """运行服务器
+    
+    dev=True 时开启代码热重载，仅用于开发；默认使用uvloop事件循环和httptools解析器。
+    注意：当前角色、代理等状态保存在进程内，多worker时各进程状态互不共享。
+    """
+    if dev:
+        uvicorn.run(
+            "server:app",
+            host=host,
+            port=port,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        uvicorn.run(
+            "server:app",
+            host=host,
+            port=port,
+            workers=workers,
+            loop="uvloop",
+            http="httptools",
+            log_level="info"
+        )
 
 if __name__ == "__main__":
-    run_server() 
\ No newline at end of file
+    run_server(
+        dev=os.getenv("SERVER_DEV", "false").lower() == "true",
+        workers=int(os.getenv("SERVER_WORKERS", "1"))
+    )
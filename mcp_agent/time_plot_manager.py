@@ -7,17 +7,24 @@ import asyncio
 import json
 import os
 import re
+import time
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import logging
 
+# 北京时间缓存有效期（秒）
+BEIJING_TIME_CACHE_TTL = 1.0
+
 class TimePlotManager:
     """时间和剧情管理器"""
     
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.beijing_timezone = timezone(timedelta(hours=8))
+        # 北京时间短期缓存：(过期时间, 北京时间)，TTL内的并发请求复用同一结果，不再逐次访问Redis
+        self._beijing_time_cache: Optional[Tuple[float, datetime]] = None
+        self._beijing_time_lock = asyncio.Lock()
         
     async def get_beijing_time_from_redis(self) -> Optional[datetime]:
         """从Redis获取北京时间"""
@@ -27,13 +34,7 @@ class TimePlotManager:
             
             time_str = await redis_client.get("beijing_time")
             if time_str:
-                # 处理可能的bytes类型
-                if isinstance(time_str, bytes):
-                    time_str = time_str.decode('utf-8')
-                elif not isinstance(time_str, str):
-                    time_str = str(time_str)
-                
-                # 解析时间字符串
+                # Redis客户端已启用decode_responses，直接解析时间字符串
                 parsed_time = datetime.fromisoformat(time_str)
                 self.logger.info(f"✅ 从Redis获取北京时间: {parsed_time}")
                 return parsed_time
@@ -78,6 +79,22 @@ class TimePlotManager:
             return False
     
     async def get_current_beijing_time(self) -> datetime:
+        """获取当前北京时间（BEIJING_TIME_CACHE_TTL秒内复用上次结果）"""
+        cached = self._beijing_time_cache
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        
+        async with self._beijing_time_lock:
+            # 等锁期间可能已被其他请求刷新
+            cached = self._beijing_time_cache
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            
+            beijing_time = await self._fetch_current_beijing_time()
+            self._beijing_time_cache = (time.monotonic() + BEIJING_TIME_CACHE_TTL, beijing_time)
+            return beijing_time
+    
+    async def _fetch_current_beijing_time(self) -> datetime:
         """获取当前北京时间（优先从Redis获取，如果没有则从工具获取）"""
         # 1. 先尝试从Redis获取
         beijing_time = await self.get_beijing_time_from_redis()
@@ -392,9 +409,33 @@ class TimePlotManager:
         Returns:
             当前时间段的剧情内容列表
         """
+        # 1. 获取当前北京时间
+        current_time = await self.get_current_beijing_time()
+        return self.get_role_plot_content_at(role_id, current_time)
+    
+    async def get_roles_current_plot_content(self, role_ids: List[str]) -> Dict[str, List[str]]:
+        """批量获取多个角色当前时间的剧情内容（所有角色共用一次北京时间查询）
+        
+        Args:
+            role_ids: 角色ID列表
+            
+        Returns:
+            {角色ID: 当前时间段的剧情内容列表}
+        """
+        current_time = await self.get_current_beijing_time()
+        return {role_id: self.get_role_plot_content_at(role_id, current_time) for role_id in role_ids}
+    
+    def get_role_plot_content_at(self, role_id: str, current_time: datetime) -> List[str]:
+        """获取角色在指定时间的剧情内容
+        
+        Args:
+            role_id: 角色ID
+            current_time: 北京时间
+            
+        Returns:
+            该时间段的剧情内容列表
+        """
         try:
-            # 1. 获取当前北京时间
-            current_time = await self.get_current_beijing_time()
             date_str = current_time.strftime('%Y-%m-%d')
             
             self.logger.info(f"获取角色 {role_id} 在 {date_str} {current_time.strftime('%H:%M')} 的剧情内容")
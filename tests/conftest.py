@@ -0,0 +1,9 @@
+"""
+测试公共配置
+mcp_agent下的模块使用平铺导入（如 from database_config import ...），将其目录加入sys.path
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "mcp_agent"))
@@ -0,0 +1,47 @@
+"""
+聊天代理测试
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import database_config
+from chat_agent import EnhancedMCPAgent
+from persistent_storage import encode_redis_message
+
+
+def _redis_message(sender_type: str, content: str, created_at: datetime) -> str:
+    return encode_redis_message({
+        'message_id': f"{sender_type}-{created_at.timestamp()}",
+        'sender_type': sender_type,
+        'message_content': content,
+        'message_order': 0,
+        'created_at': created_at.isoformat()
+    }).decode()
+
+
+def test_recent_conversation_history_reads_encoded_redis_messages(monkeypatch):
+    """紧凑数组格式的Redis消息经解码后按created_at过滤出近期对话"""
+    now = datetime.now()
+    messages = [
+        _redis_message('user', '半小时前的消息', now - timedelta(minutes=30)),
+        _redis_message('user', '你好', now - timedelta(minutes=2)),
+        _redis_message('agent', '你好呀', now - timedelta(minutes=1)),
+    ]
+    
+    class FakeRedis:
+        async def lrange(self, key, start, end):
+            return messages
+    
+    async def fake_get_redis_client():
+        return FakeRedis()
+    
+    monkeypatch.setattr(database_config, "get_redis_client", fake_get_redis_client)
+    agent = EnhancedMCPAgent.__new__(EnhancedMCPAgent)
+    agent.logger = logging.getLogger(__name__)
+    
+    recent = asyncio.run(agent._get_recent_conversation_history("session", minutes=10))
+    
+    assert [(msg['type'], msg['content']) for msg in recent] == [('user', '你好'), ('agent', '你好呀')]
+    assert all(msg['timestamp'] for msg in recent)
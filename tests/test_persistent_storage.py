@@ -0,0 +1,50 @@
+"""
+持久化存储测试
+MySQL部分使用SQLite内存库（aiosqlite）代替
+"""
+
+import asyncio
+from datetime import datetime
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+import database_config
+from database_models import Base, ChatSession
+from persistent_storage import PersistentConversationStorage
+
+
+def test_user_sessions_pagination_keeps_sessions_with_tied_timestamps(monkeypatch):
+    """同一秒的多个会话跨越页边界时，组合游标翻页不应跳过任何会话"""
+    async def scenario():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        monkeypatch.setattr(
+            database_config, "async_session_maker",
+            async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        )
+        
+        tied = datetime(2025, 6, 3, 12, 0, 0)
+        async with database_config.async_session_maker() as session:
+            session.add_all([
+                ChatSession(session_id=f"session-{i}", user_name="user", session_title=f"会话 {i}",
+                            created_at=tied, last_message_at=tied, status="active")
+                for i in range(5)
+            ])
+            await session.commit()
+        
+        storage = PersistentConversationStorage()
+        seen = []
+        before = before_session_id = None
+        while True:
+            page = await storage.get_user_sessions("user", limit=2, before=before, before_session_id=before_session_id)
+            seen.extend(session["session_id"] for session in page)
+            if len(page) < 2:
+                break
+            before = datetime.fromisoformat(page[-1]["last_message_at"])
+            before_session_id = page[-1]["session_id"]
+        
+        await engine.dispose()
+        return seen
+    
+    assert asyncio.run(scenario()) == [f"session-{i}" for i in (4, 3, 2, 1, 0)]
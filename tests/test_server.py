@@ -0,0 +1,48 @@
+"""
+服务端接口测试
+"""
+
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+class FakeTimePlotManager:
+    """剧情内容固定、时间每次调用前进一分钟的时间剧情管理器"""
+    
+    def __init__(self, plot_content):
+        self.plot_content = plot_content
+        self.now = datetime(2025, 6, 3, 8, 0, 0)
+    
+    async def get_role_current_plot_content(self, role_id):
+        return list(self.plot_content)
+    
+    async def get_current_beijing_time(self):
+        self.now += timedelta(minutes=1)
+        return self.now
+
+
+def test_plot_etag_is_stable_across_refreshes_with_same_content(monkeypatch):
+    """剧情内容不变时，缓存刷新前后ETag相同，携带If-None-Match的请求返回304"""
+    monkeypatch.setattr(server, "time_plot_manager", FakeTimePlotManager(["8:00-8:30 起床洗漱"]))
+    server.invalidate_role_plot_cache("role_001")
+    client = TestClient(server.app)
+    
+    first = client.get("/roles/role_001/plot")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    
+    # 模拟一次缓存刷新：重新获取时获取时间已变化，但剧情内容相同
+    server.invalidate_role_plot_cache("role_001")
+    second = client.get("/roles/role_001/plot")
+    assert second.status_code == 200
+    assert second.headers["etag"] == etag
+    assert second.json()["fetched_at"] != first.json()["fetched_at"]
+    
+    not_modified = client.get("/roles/role_001/plot", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    
+    server.invalidate_role_plot_cache("role_001")